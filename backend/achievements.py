@@ -0,0 +1,141 @@
+"""
+Модуль достижений (геймификация)
+
+Каталог ACHIEVEMENTS декларативный: у каждого достижения есть метрика и порог.
+События (завершена сессия, задача, запись благодарности/настроения, игра)
+передают только свои метрики, и проверяются только зависящие от них правила.
+Счётчики пользователя хранятся в AchievementProgress и меняются на дельту,
+поэтому проверка не пересчитывает историю: одна строка прогресса на событие.
+"""
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+
+from models import db, Achievement, AchievementProgress, Task, GratitudeEntry, MoodEntry, MemoryGameScore
+
+# Определение всех достижений: metric - имя метрики события, min - порог
+ACHIEVEMENTS = {
+    'first_session': {'name': 'Первый шаг', 'icon': '🌱', 'desc': 'Завершите первую сессию фокуса', 'metric': 'total_sessions', 'min': 1},
+    'sessions_10': {'name': 'Начинающий', 'icon': '🌿', 'desc': 'Завершите 10 сессий', 'metric': 'total_sessions', 'min': 10},
+    'sessions_50': {'name': 'Практик', 'icon': '🌳', 'desc': 'Завершите 50 сессий', 'metric': 'total_sessions', 'min': 50},
+    'sessions_100': {'name': 'Мастер фокуса', 'icon': '🏆', 'desc': 'Завершите 100 сессий', 'metric': 'total_sessions', 'min': 100},
+    'streak_3': {'name': 'Три дня подряд', 'icon': '🔥', 'desc': '3 дня подряд с сессиями', 'metric': 'streak_days', 'min': 3},
+    'streak_7': {'name': 'Неделя силы', 'icon': '💪', 'desc': '7 дней подряд с сессиями', 'metric': 'streak_days', 'min': 7},
+    'streak_30': {'name': 'Месяц дисциплины', 'icon': '⭐', 'desc': '30 дней подряд', 'metric': 'streak_days', 'min': 30},
+    'hours_10': {'name': '10 часов фокуса', 'icon': '⏰', 'desc': 'Накопите 10 часов фокуса', 'metric': 'focus_minutes', 'min': 600},
+    'hours_50': {'name': '50 часов фокуса', 'icon': '🎯', 'desc': 'Накопите 50 часов фокуса', 'metric': 'focus_minutes', 'min': 3000},
+    'hours_100': {'name': 'Центурион', 'icon': '👑', 'desc': 'Накопите 100 часов фокуса', 'metric': 'focus_minutes', 'min': 6000},
+    'perfect_session': {'name': 'Идеальная сессия', 'icon': '✨', 'desc': 'Сессия без отвлечений', 'metric': 'perfect_session', 'min': 1},
+    'early_bird': {'name': 'Ранняя пташка', 'icon': '🌅', 'desc': 'Сессия до 7 утра', 'metric': 'early_session', 'min': 1},
+    'night_owl': {'name': 'Ночная сова', 'icon': '🦉', 'desc': 'Сессия после 23:00', 'metric': 'late_session', 'min': 1},
+    'tree_level_5': {'name': 'Садовник', 'icon': '🌲', 'desc': 'Дерево достигло 5 уровня', 'metric': 'tree_level', 'min': 5},
+    'tree_level_10': {'name': 'Лесник', 'icon': '🌴', 'desc': 'Дерево достигло 10 уровня', 'metric': 'tree_level', 'min': 10},
+    'tasks_10': {'name': 'Продуктивный', 'icon': '📋', 'desc': 'Завершите 10 задач', 'metric': 'tasks_completed', 'min': 10},
+    'tasks_50': {'name': 'Машина', 'icon': '🚀', 'desc': 'Завершите 50 задач', 'metric': 'tasks_completed', 'min': 50},
+    'gratitude_7': {'name': 'Благодарный', 'icon': '🙏', 'desc': '7 записей благодарности', 'metric': 'gratitude_entries', 'min': 7},
+    'mood_streak_7': {'name': 'Самопознание', 'icon': '💭', 'desc': '7 дней записей настроения', 'metric': 'mood_entries', 'min': 7},
+    'memory_master': {'name': 'Острый ум', 'icon': '🧠', 'desc': 'Достигните 10 уровня в игре на память', 'metric': 'memory_best_level', 'min': 10},
+}
+
+# Правила по метрикам: событие проверяет только свои достижения
+RULES_BY_METRIC = {}
+for _type, _achievement in ACHIEVEMENTS.items():
+    RULES_BY_METRIC.setdefault(_achievement['metric'], []).append((_type, _achievement['min']))
+
+# Счётчики AchievementProgress и их начальные значения по истории (один раз на пользователя)
+PROGRESS_COUNTERS = {
+    'tasks_completed': lambda user_id: Task.query.filter_by(user_id=user_id, status='completed').count(),
+    'gratitude_entries': lambda user_id: GratitudeEntry.query.filter_by(user_id=user_id).count(),
+    'mood_entries': lambda user_id: MoodEntry.query.filter_by(user_id=user_id).count(),
+    'memory_best_level': lambda user_id: db.session.query(
+        db.func.max(MemoryGameScore.level)).filter_by(user_id=user_id).scalar() or 0,
+}
+
+
+def get_progress(user_id):
+    """
+    Строка прогресса пользователя. Если её ещё нет - создаётся по текущему
+    состоянию БД (включая незакоммиченные изменения запроса); тогда второй
+    элемент - True, и дельту события применять не нужно. Вставка через
+    ON CONFLICT DO NOTHING: строку, которую успел создать параллельный запрос,
+    просто читаем, и дельта применяется к ней.
+    """
+    progress = db.session.get(AchievementProgress, user_id)
+    if progress is not None:
+        return progress, False
+
+    unlocked = [a.achievement_type for a in Achievement.query.filter_by(user_id=user_id)]
+    result = db.session.execute(sqlite_insert(AchievementProgress).values(
+        user_id=user_id,
+        unlocked=','.join(sorted(set(unlocked))),
+        **{counter: initial(user_id) for counter, initial in PROGRESS_COUNTERS.items()}
+    ).on_conflict_do_nothing(index_elements=['user_id']))
+    return db.session.get(AchievementProgress, user_id), result.rowcount == 1
+
+
+def unlock_achievements(user_id, progress=None, **metrics):
+    """Открыть достижения, пороги которых достигнуты переданными метриками (без коммита)"""
+    if progress is None:
+        progress, _ = get_progress(user_id)
+
+    unlocked_types = set(filter(None, (progress.unlocked or '').split(',')))
+    unlocked = []
+    for metric, value in metrics.items():
+        for achievement_type, threshold in RULES_BY_METRIC.get(metric, ()):
+            if value >= threshold and achievement_type not in unlocked_types:
+                db.session.add(Achievement(user_id=user_id, achievement_type=achievement_type))
+                unlocked_types.add(achievement_type)
+                unlocked.append({
+                    'type': achievement_type,
+                    'name': ACHIEVEMENTS[achievement_type]['name'],
+                    'icon': ACHIEVEMENTS[achievement_type]['icon']
+                })
+
+    if unlocked:
+        progress.unlocked = ','.join(sorted(unlocked_types))
+    return unlocked
+
+
+def change_counter(user_id, counter, delta):
+    """Изменить счётчик прогресса на delta и проверить зависящие от него достижения"""
+    progress, created = get_progress(user_id)
+    if not created:
+        setattr(progress, counter, max(0, (getattr(progress, counter) or 0) + delta))
+    if delta <= 0:
+        return []
+    return unlock_achievements(user_id, progress, **{counter: getattr(progress, counter)})
+
+
+def record_memory_level(user_id, level):
+    """Новый результат игры на память: счётчик хранит лучший уровень"""
+    progress, _ = get_progress(user_id)
+    progress.memory_best_level = max(progress.memory_best_level or 0, level)
+    return unlock_achievements(user_id, progress, memory_best_level=progress.memory_best_level)
+
+
+def tree_metrics(tree):
+    """Метрики достижений, которые хранит само дерево"""
+    return {
+        'total_sessions': tree.total_sessions or 0,
+        'streak_days': tree.streak_days or 0,
+        'focus_minutes': tree.total_focus_minutes or 0,
+        'tree_level': tree.level or 1,
+    }
+
+
+def record_focus_session(user_id, tree, distractions, hour):
+    """Завершённая сессия фокуса: метрики дерева и особенности самой сессии"""
+    return unlock_achievements(
+        user_id,
+        perfect_session=int(distractions == 0),
+        early_session=int(hour < 7),
+        late_session=int(hour >= 23),
+        **tree_metrics(tree)
+    )
+
+
+def check_all_achievements(user_id, tree=None):
+    """Полная проверка по всем счётчикам (ручной пересмотр)"""
+    progress, _ = get_progress(user_id)
+    metrics = {counter: getattr(progress, counter) or 0 for counter in PROGRESS_COUNTERS}
+    if tree is not None:
+        metrics.update(tree_metrics(tree))
+    return unlock_achievements(user_id, progress, **metrics)
@@ -1,20 +1,38 @@
-from flask import Flask, jsonify, render_template, request, redirect, url_for, session, send_from_directory
+from flask import Flask, jsonify, make_response, render_template, request, redirect, url_for, session, send_from_directory, Response, stream_with_context
 from flask_cors import CORS
 from flask_login import LoginManager, login_user, logout_user, login_required, current_user
 from flask_bcrypt import Bcrypt
 from authlib.integrations.flask_client import OAuth
-from models import db, User, Task, Playlist, Track, Note, Chat, Message, FocusSession, BlockedUser, FocusTree, FocusSettings, Subtask, MoodEntry, TaskTemplate, TaskTimeLog, Achievement, GratitudeEntry, MemoryGameScore, YandexDiskToken, CloudFile
+from models import db, friendships, User, Task, Playlist, Track, Note, Chat, ChatMember, Message, FocusSession, BlockedUser, FocusTree, FocusRollup, FocusLeaderboard, FocusSettings, Subtask, MoodEntry, TaskTemplate, TaskTimeLog, Achievement, GratitudeEntry, MemoryGameScore, MemoryGameBest, YandexDiskToken, CloudFile
 from config import Config
-from datetime import datetime
+from datetime import datetime, timezone
+from sqlalchemy import event as sa_event
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import joinedload, selectinload
+from functools import wraps
+from urllib.parse import urlencode
 from werkzeug.utils import secure_filename
 from mutagen import File as MutagenFile
 from mutagen.easyid3 import EasyID3
 from mutagen.mp3 import MP3
 from yandex_disk import YandexDiskAPI
+from chat_events import broker as chat_broker, format_sse
+from cache import IdempotencyStore, LRUCache, MISSING, StatsCache, create_cache_backend
+from presence import PresenceStore, TypingStore
+from leaderboards import Leaderboards
+from focus_events import apply_events, finish_tracking, parse_events
+from search import ensure_search_indexes, search_messages, search_users as find_users
+import bulk
+from ranking import crowded_groups, move, next_rank, rebalance
+from achievements import ACHIEVEMENTS, change_counter, check_all_achievements, record_focus_session, record_memory_level
+import atexit
+import click
 import os
 import uuid
 import json
+import queue
 import tempfile
+import time
 
 # Абсолютный путь к папке uploads относительно директории приложения
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
@@ -69,6 +87,123 @@ bcrypt = Bcrypt(app)
 login_manager = LoginManager(app)
 login_manager.login_view = 'login_page'
 
+# Роли участников чатов: (chat_id, user_id) -> права, чтобы не ходить в chat_members_v2 на каждый запрос
+chat_access_cache = LRUCache(
+    maxsize=app.config['CHAT_ACCESS_CACHE_SIZE'],
+    ttl=app.config['CHAT_ACCESS_CACHE_TTL']
+)
+
+# Онлайн-статус в памяти процесса, users.last_seen обновляется пачками
+presence = PresenceStore(flush_interval=app.config['PRESENCE_FLUSH_INTERVAL'])
+typing_store = TypingStore(ttl=app.config['TYPING_TTL'])
+
+# Готовые ответы статистики по пользователю; сбрасываются записью в соответствующую область
+stats_cache = StatsCache(create_cache_backend(
+    app.config['STATS_CACHE_BACKEND'],
+    maxsize=app.config['STATS_CACHE_SIZE'],
+    ttl=app.config['STATS_CACHE_TTL'],
+    path=app.config['STATS_CACHE_PATH']
+))
+
+# Ответы на создающие запросы по заголовку Idempotency-Key (повтор не создаёт запись второй раз)
+idempotency_store = IdempotencyStore(create_cache_backend(
+    app.config['IDEMPOTENCY_BACKEND'],
+    maxsize=app.config['IDEMPOTENCY_SIZE'],
+    ttl=app.config['IDEMPOTENCY_TTL'],
+    path=app.config['IDEMPOTENCY_PATH']
+))
+
+# Первые места рейтингов в памяти процесса (обновляются при записи результатов)
+leaderboards = Leaderboards(size=app.config['LEADERBOARD_SIZE'], ttl=app.config['LEADERBOARD_TTL'])
+
+
+def cached_stats(*scopes, should_cache=None):
+    """Кэшировать JSON-ответ эндпоинта статистики для текущего пользователя.
+    scopes - области данных (focus, tasks, mood), запись в которые сбрасывает кэш."""
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            name = f'{request.endpoint}?{urlencode(sorted(request.args.items()))}'
+            data = stats_cache.get_or_compute(
+                current_user.id, scopes, name,
+                lambda: view(*args, **kwargs).get_json(),
+                should_cache=should_cache
+            )
+            return jsonify(data)
+        return wrapper
+    return decorator
+
+
+def idempotent(view):
+    """Повтор запроса с тем же заголовком Idempotency-Key получает сохранённый ответ
+    первого, а не выполняет его ещё раз. Без заголовка запрос выполняется как обычно."""
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        client_key = request.headers.get('Idempotency-Key')
+        if not client_key:
+            return view(*args, **kwargs)
+        if len(client_key) > 255:
+            return jsonify({'error': 'Idempotency-Key длиннее 255 символов'}), 400
+        
+        key = f'idem:{current_user.id}:{client_key}'
+        # Тело файловых загрузок не читаем заранее (его разбирает сама view), для них хватает пути
+        body = b'' if request.mimetype == 'multipart/form-data' else request.get_data()
+        fingerprint = IdempotencyStore.fingerprint(request.method, request.path, body)
+        saved = idempotency_store.begin(key, fingerprint)
+        if saved is not None:
+            if saved['fingerprint'] != fingerprint:
+                return jsonify({'error': 'Idempotency-Key уже использован для другого запроса'}), 422
+            if saved['status'] is None:
+                return jsonify({'error': 'Запрос с этим Idempotency-Key ещё выполняется'}), 409
+            response = app.response_class(saved['body'], status=saved['status'], mimetype=saved['mimetype'])
+            response.headers['Idempotent-Replayed'] = 'true'
+            return response
+        
+        try:
+            response = make_response(view(*args, **kwargs))
+        except Exception:
+            idempotency_store.release(key)
+            raise
+        if response.status_code >= 500:
+            idempotency_store.release(key)
+        else:
+            idempotency_store.finish(key, fingerprint, response.status_code,
+                                     response.get_data(as_text=True), response.mimetype)
+        return response
+    return wrapper
+
+
+def flush_presence():
+    """Записать накопленные пинги в users.last_seen одним executemany"""
+    pending = presence.take_pending()
+    if not pending:
+        return
+    users = User.__table__
+    try:
+        # Отдельное соединение: не задеваем незакоммиченные изменения текущего запроса
+        with db.engine.begin() as conn:
+            conn.execute(
+                users.update().where(users.c.id == db.bindparam('user_id')).values(last_seen=db.bindparam('seen')),
+                [{'user_id': user_id, 'seen': seen} for user_id, seen in pending.items()]
+            )
+    except Exception as e:
+        presence.restore_pending(pending)
+        print(f"Error flushing presence: {e}")
+
+
+@app.after_request
+def flush_presence_if_due(response):
+    """Запись онлайн-статуса попутно с обычными запросами"""
+    if presence.flush_due():
+        flush_presence()
+    return response
+
+
+@atexit.register
+def flush_presence_on_exit():
+    with app.app_context():
+        flush_presence()
+
 # Google OAuth
 oauth = OAuth(app)
 if app.config['GOOGLE_CLIENT_ID']:
@@ -90,6 +225,10 @@ def load_user(user_id):
 # Создание таблиц
 with app.app_context():
     db.create_all()
+    # Полнотекстовые индексы сообщений и пользователей (FTS5 есть только в SQLite)
+    if db.engine.dialect.name == 'sqlite':
+        with db.engine.begin() as conn:
+            ensure_search_indexes(conn)
 
 # ==================== СТРАНИЦЫ ====================
 
@@ -118,7 +257,7 @@ def register_page():
 @app.route('/dashboard')
 @login_required
 def dashboard():
-    return render_template('dashboard.html')
+    return render_template('dashboard.html', chat_events_enabled=app.config['CHAT_EVENTS_ENABLED'])
 
 @app.route('/profile')
 @login_required
@@ -143,12 +282,7 @@ def join_chat_page(invite_link):
     
     if current_user.is_authenticated:
         # Если пользователь авторизован, присоединяем и редиректим
-        if current_user not in chat.members:
-            chat.members.append(current_user)
-            from models import ChatMember
-            member = ChatMember(chat_id=chat.id, user_id=current_user.id, role='member')
-            db.session.add(member)
-            db.session.commit()
+        join_chat(chat, current_user.id)
         return redirect(url_for('dashboard') + f'#chat-{chat.id}')
     else:
         # Если не авторизован, показываем страницу с информацией о чате
@@ -369,6 +503,7 @@ def yandex_disconnect():
 
 @app.route('/api/yandex/upload', methods=['POST'])
 @login_required
+@idempotent
 def yandex_upload():
     """Загрузить файл на Яндекс.Диск"""
     try:
@@ -647,11 +782,66 @@ def yandex_delete(file_id):
 @app.route('/api/tasks', methods=['GET'])
 @login_required
 def get_tasks():
-    tasks = Task.query.filter_by(user_id=current_user.id).order_by(Task.created_at.desc()).all()
+    """
+    Задачи пользователя, новые первыми. Параметры:
+    status - статус или несколько через запятую; updated_since - ISO-время, только изменённые после;
+    limit + before_id - страница после задачи before_id (курсор следующей - в X-Next-Before-Id);
+    subtasks=counts - только счётчики подзадач, без списка.
+    """
+    query = Task.query.filter(Task.user_id == current_user.id)
+    
+    status = request.args.get('status')
+    if status:
+        query = query.filter(Task.status.in_(status.split(',')))
+    
+    updated_since = request.args.get('updated_since')
+    if updated_since:
+        try:
+            since = datetime.fromisoformat(updated_since.replace('Z', '+00:00'))
+        except ValueError:
+            return jsonify({'error': 'updated_since должен быть в формате ISO 8601'}), 400
+        if since.tzinfo is not None:
+            since = since.astimezone(timezone.utc).replace(tzinfo=None)
+        query = query.filter(Task.updated_at > since)
+    
+    # Keyset по (created_at, id): страница не зависит от задач, добавленных выше
+    before_id = request.args.get('before_id', type=int)
+    if before_id:
+        cursor = db.session.query(Task.created_at).filter_by(id=before_id, user_id=current_user.id).scalar()
+        if cursor is None:
+            return jsonify({'error': 'Задача before_id не найдена'}), 400
+        query = query.filter(db.tuple_(Task.created_at, Task.id) < db.tuple_(cursor, before_id))
+    
+    query = query.order_by(Task.created_at.desc(), Task.id.desc())
+    limit = request.args.get('limit', type=int)
+    if limit:
+        limit = min(max(limit, 1), app.config['TASKS_PAGE_MAX'])
+        tasks = query.limit(limit + 1).all()
+        has_more = len(tasks) > limit
+        tasks = tasks[:limit]
+    else:
+        tasks = query.all()
+        has_more = False
+    
+    # Подзадачи всей страницы одним запросом (или только счётчики одной группировкой)
+    task_ids = [t.id for t in tasks]
+    subtasks_by_task = {task_id: [] for task_id in task_ids}
+    counts = {}
+    if task_ids and request.args.get('subtasks') == 'counts':
+        subtasks_by_task = None
+        counts = {task_id: (total, done or 0) for task_id, total, done in db.session.query(
+            Subtask.task_id, db.func.count(Subtask.id), db.func.sum(db.cast(Subtask.is_completed, db.Integer))
+        ).filter(Subtask.task_id.in_(task_ids)).group_by(Subtask.task_id)}
+    elif task_ids:
+        for s in Subtask.query.filter(Subtask.task_id.in_(task_ids)).order_by(Subtask.task_id, Subtask.order):
+            subtasks_by_task[s.task_id].append(s)
+        counts = {task_id: (len(items), sum(1 for s in items if s.is_completed))
+                  for task_id, items in subtasks_by_task.items()}
+    
     result = []
     for t in tasks:
-        subtasks = Subtask.query.filter_by(task_id=t.id).order_by(Subtask.order).all()
-        result.append({
+        total, completed = counts.get(t.id, (0, 0))
+        item = {
             'id': t.id,
             'title': t.title,
             'description': t.description,
@@ -664,34 +854,31 @@ def get_tasks():
             'ambient_sound': getattr(t, 'ambient_sound', 'none'),
             'playlist_id': t.playlist_id,
             'created_at': t.created_at.isoformat(),
-            'subtasks': [{
+            'updated_at': t.updated_at.isoformat() if t.updated_at else None,
+            'subtasks_completed': completed,
+            'subtasks_total': total
+        }
+        if subtasks_by_task is not None:
+            item['subtasks'] = [{
                 'id': s.id,
                 'title': s.title,
                 'is_completed': s.is_completed,
                 'order': s.order
-            } for s in subtasks],
-            'subtasks_completed': sum(1 for s in subtasks if s.is_completed),
-            'subtasks_total': len(subtasks)
-        })
-    return jsonify(result)
+            } for s in subtasks_by_task[t.id]]
+        result.append(item)
+    
+    response = jsonify(result)
+    response.headers['X-Has-More'] = 'true' if has_more else 'false'
+    if has_more:
+        response.headers['X-Next-Before-Id'] = str(tasks[-1].id)
+    return response
 
 @app.route('/api/tasks', methods=['POST'])
 @login_required
+@idempotent
 def create_task():
     data = request.json
-    
-    # Защита от дублирования: проверяем, не создавалась ли задача с таким же названием в последние 5 секунд
-    from datetime import timedelta
     title = data.get('title', '')
-    five_seconds_ago = datetime.utcnow() - timedelta(seconds=5)
-    recent_duplicate = Task.query.filter(
-        Task.user_id == current_user.id,
-        Task.title == title,
-        Task.created_at >= five_seconds_ago
-    ).first()
-    
-    if recent_duplicate:
-        return jsonify({'success': True, 'id': recent_duplicate.id, 'duplicate': True})
     
     # Обработка playlist_id
     playlist_id = data.get('playlist_id')
@@ -714,6 +901,7 @@ def create_task():
     )
     db.session.add(task)
     db.session.commit()
+    stats_cache.invalidate(current_user.id, 'tasks')
     return jsonify({'success': True, 'id': task.id})
 
 @app.route('/api/tasks/<int:task_id>', methods=['PUT'])
@@ -721,6 +909,7 @@ def create_task():
 def update_task(task_id):
     task = Task.query.filter_by(id=task_id, user_id=current_user.id).first_or_404()
     data = request.json
+    was_completed = task.status == 'completed'
     
     task.title = data.get('title', task.title)
     task.description = data.get('description', task.description)
@@ -731,18 +920,99 @@ def update_task(task_id):
     if task.status == 'completed' and not task.completed_at:
         task.completed_at = datetime.utcnow()
     
+    # Счётчик завершённых задач для достижений
+    unlocked = []
+    if (task.status == 'completed') != was_completed:
+        unlocked = change_counter(current_user.id, 'tasks_completed', -1 if was_completed else 1)
+    
     db.session.commit()
-    return jsonify({'success': True})
+    stats_cache.invalidate(current_user.id, 'tasks')
+    return jsonify({'success': True, 'unlocked': unlocked})
 
 @app.route('/api/tasks/<int:task_id>', methods=['DELETE'])
 @login_required
 def delete_task(task_id):
     task = Task.query.filter_by(id=task_id, user_id=current_user.id).first_or_404()
+    was_completed = task.status == 'completed'
     db.session.delete(task)
+    if was_completed:
+        change_counter(current_user.id, 'tasks_completed', -1)
     db.session.commit()
+    stats_cache.invalidate(current_user.id, 'tasks')
     return jsonify({'success': True})
 
 
+TASK_STATUSES = ('pending', 'in_progress', 'completed')
+
+
+def task_status(value):
+    if value not in TASK_STATUSES:
+        raise ValueError(value)
+    return value
+
+
+# Поля, которые можно менять пакетно, и приведение типов
+TASK_BULK_FIELDS = {
+    'title': bulk.title, 'description': bulk.text, 'status': task_status,
+    'priority': bulk.integer, 'timer_minutes': bulk.integer
+}
+
+
+@app.route('/api/tasks/bulk', methods=['POST'])
+@login_required
+def bulk_tasks():
+    """Пакетные изменения задач одной транзакцией:
+    {"operations": [{"op": "update", "id": 1, "status": "completed"}, {"op": "delete", "id": 2}]}"""
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict):
+        return jsonify({'error': 'Ожидается JSON-объект с полем operations'}), 400
+    try:
+        updates, deletes = bulk.parse_operations(
+            data.get('operations'), TASK_BULK_FIELDS, app.config['BULK_MAX_OPERATIONS'])
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    
+    # Права на все задачи одним запросом; если чего-то нет - не меняем ничего
+    ids = set(updates) | deletes
+    statuses = dict(db.session.query(Task.id, Task.status).filter(
+        Task.user_id == current_user.id, Task.id.in_(ids)))
+    missing = sorted(ids - statuses.keys())
+    if missing:
+        return jsonify({'error': 'Задачи не найдены', 'missing': missing}), 404
+    
+    now = datetime.utcnow()
+    if updates:
+        values = bulk.case_values(Task, updates)
+        completing = [task_id for task_id, v in updates.items() if v.get('status') == 'completed']
+        if completing:
+            values['completed_at'] = db.case(
+                (db.and_(Task.id.in_(completing), Task.completed_at.is_(None)), now),
+                else_=Task.completed_at
+            )
+        values['updated_at'] = now
+        Task.query.filter(Task.id.in_(updates)).update(values, synchronize_session=False)
+    
+    if deletes:
+        # Как при удалении по одной: подзадачи удаляются, сессии и учёт времени остаются без задачи
+        FocusSession.query.filter(FocusSession.task_id.in_(deletes)).update(
+            {'task_id': None}, synchronize_session=False)
+        TaskTimeLog.query.filter(TaskTimeLog.task_id.in_(deletes)).update(
+            {'task_id': None}, synchronize_session=False)
+        Subtask.query.filter(Subtask.task_id.in_(deletes)).delete(synchronize_session=False)
+        Task.query.filter(Task.id.in_(deletes)).delete(synchronize_session=False)
+    
+    # Счётчик завершённых задач для достижений: переходы в completed и обратно
+    delta = sum(
+        (fields.get('status', statuses[task_id]) == 'completed') - (statuses[task_id] == 'completed')
+        for task_id, fields in updates.items()
+    ) - sum(statuses[task_id] == 'completed' for task_id in deletes)
+    unlocked = change_counter(current_user.id, 'tasks_completed', delta) if delta else []
+    
+    db.session.commit()
+    stats_cache.invalidate(current_user.id, 'tasks')
+    return jsonify({'success': True, 'updated': len(updates), 'deleted': len(deletes), 'unlocked': unlocked})
+
+
 # ==================== API: ПОДЗАДАЧИ ====================
 
 @app.route('/api/tasks/<int:task_id>/subtasks', methods=['GET'])
@@ -766,15 +1036,13 @@ def create_subtask(task_id):
     task = Task.query.filter_by(id=task_id, user_id=current_user.id).first_or_404()
     data = request.json
     
-    # Получаем максимальный order
-    max_order = db.session.query(db.func.max(Subtask.order)).filter_by(task_id=task_id).scalar() or 0
-    
     subtask = Subtask(
         task_id=task_id,
         title=data['title'],
-        order=max_order + 1
+        order=next_rank(Subtask, Subtask.task_id, task_id)
     )
     db.session.add(subtask)
+    task.updated_at = datetime.utcnow()
     db.session.commit()
     
     return jsonify({
@@ -800,6 +1068,13 @@ def update_subtask(subtask_id):
         subtask.is_completed = data['is_completed']
     if 'order' in data:
         subtask.order = data['order']
+    if 'after_id' in data:
+        # Перетаскивание: встать после подзадачи after_id (null - в начало), меняется одна строка
+        try:
+            move(subtask, Subtask.task_id, data['after_id'])
+        except LookupError:
+            return jsonify({'error': 'Подзадача after_id не найдена в этой задаче'}), 400
+    task.updated_at = datetime.utcnow()
     
     db.session.commit()
     return jsonify({'success': True})
@@ -813,10 +1088,46 @@ def delete_subtask(subtask_id):
     task = Task.query.filter_by(id=subtask.task_id, user_id=current_user.id).first_or_404()
     
     db.session.delete(subtask)
+    task.updated_at = datetime.utcnow()
     db.session.commit()
     return jsonify({'success': True})
 
 
+SUBTASK_BULK_FIELDS = {'title': bulk.title, 'is_completed': bulk.boolean, 'order': bulk.number}
+
+
+@app.route('/api/subtasks/bulk', methods=['POST'])
+@login_required
+def bulk_subtasks():
+    """Пакетные изменения подзадач (порядок, отметки, удаление) одной транзакцией"""
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict):
+        return jsonify({'error': 'Ожидается JSON-объект с полем operations'}), 400
+    try:
+        updates, deletes = bulk.parse_operations(
+            data.get('operations'), SUBTASK_BULK_FIELDS, app.config['BULK_MAX_OPERATIONS'])
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    
+    ids = set(updates) | deletes
+    task_ids = dict(db.session.query(Subtask.id, Subtask.task_id).join(Task, Task.id == Subtask.task_id).filter(
+        Task.user_id == current_user.id, Subtask.id.in_(ids)))
+    missing = sorted(ids - task_ids.keys())
+    if missing:
+        return jsonify({'error': 'Подзадачи не найдены', 'missing': missing}), 404
+    
+    if updates:
+        Subtask.query.filter(Subtask.id.in_(updates)).update(
+            bulk.case_values(Subtask, updates), synchronize_session=False)
+    if deletes:
+        Subtask.query.filter(Subtask.id.in_(deletes)).delete(synchronize_session=False)
+    Task.query.filter(Task.id.in_(set(task_ids.values()))).update(
+        {'updated_at': datetime.utcnow()}, synchronize_session=False)
+    
+    db.session.commit()
+    return jsonify({'success': True, 'updated': len(updates), 'deleted': len(deletes)})
+
+
 # ==================== API: ПЛЕЙЛИСТЫ ====================
 
 @app.route('/api/playlists', methods=['GET'])
@@ -843,21 +1154,38 @@ def create_playlist():
     db.session.commit()
     return jsonify({'success': True, 'id': playlist.id})
 
+def serialize_track(t):
+    """Сериализовать трек для API"""
+    return {
+        'id': t.id,
+        'title': t.title,
+        'artist': t.artist,
+        'url': t.url,
+        'duration': t.duration,
+        'order': t.order
+    }
+
+
+def insert_tracks(rows):
+    """Вставить треки одним INSERT ... RETURNING и вернуть их данные для API (без коммита).
+    Порядок строк RETURNING SQLite не гарантирует, поэтому сортируем по рангу (в пачке он у всех разный).
+    Сериализуем до коммита: после него объекты устаревают и перечитывались бы по одному."""
+    if not rows:
+        return []
+    tracks = db.session.scalars(db.insert(Track).returning(Track), rows).all()
+    return [serialize_track(t) for t in sorted(tracks, key=lambda t: t.order)]
+
+
 @app.route('/api/playlists/<int:playlist_id>/tracks', methods=['GET'])
 @login_required
 def get_playlist_tracks(playlist_id):
     playlist = Playlist.query.filter_by(id=playlist_id, user_id=current_user.id).first_or_404()
     tracks = Track.query.filter_by(playlist_id=playlist_id).order_by(Track.order).all()
-    return jsonify([{
-        'id': t.id,
-        'title': t.title,
-        'artist': t.artist,
-        'url': t.url,
-        'duration': t.duration
-    } for t in tracks])
+    return jsonify([serialize_track(t) for t in tracks])
 
 @app.route('/api/playlists/<int:playlist_id>/tracks', methods=['POST'])
 @login_required
+@idempotent
 def add_track(playlist_id):
     playlist = Playlist.query.filter_by(id=playlist_id, user_id=current_user.id).first_or_404()
     
@@ -867,53 +1195,56 @@ def add_track(playlist_id):
     if not files or all(f.filename == '' for f in files):
         return jsonify({'error': 'Файлы не выбраны'}), 400
     
-    added_tracks = []
-    errors = []
-    max_order = db.session.query(db.func.max(Track.order)).filter_by(playlist_id=playlist_id).scalar() or 0
+    results = []  # По файлу на элемент, в порядке загрузки
+    rows = []
+    rank = next_rank(Track, Track.playlist_id, playlist_id)
     
     for file in files:
         if file.filename == '':
             continue
             
         if not allowed_file(file.filename):
-            errors.append(f'{file.filename}: недопустимый формат')
+            results.append({'filename': file.filename, 'success': False, 'error': 'недопустимый формат'})
             continue
         
         # Генерируем уникальное имя файла
         ext = file.filename.rsplit('.', 1)[1].lower()
         filename = f"{uuid.uuid4().hex}.{ext}"
         filepath = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-        file.save(filepath)
+        try:
+            file.save(filepath)
+        except OSError:
+            results.append({'filename': file.filename, 'success': False, 'error': 'не удалось сохранить файл'})
+            continue
         
         # Извлекаем метаданные из файла
         meta_title, meta_artist, duration = extract_audio_metadata(filepath)
         
         # Для множественной загрузки используем метаданные или имя файла
-        title = meta_title or file.filename.rsplit('.', 1)[0]
-        artist = meta_artist or 'Неизвестный исполнитель'
-        
-        max_order += 1
-        track = Track(
-            playlist_id=playlist_id,
-            title=title,
-            artist=artist,
-            url=f'/uploads/music/{filename}',
-            duration=duration,
-            order=max_order
-        )
-        db.session.add(track)
-        added_tracks.append({'id': None, 'title': title, 'artist': artist})
+        rows.append({
+            'playlist_id': playlist_id,
+            'title': meta_title or file.filename.rsplit('.', 1)[0],
+            'artist': meta_artist or 'Неизвестный исполнитель',
+            'url': f'/uploads/music/{filename}',
+            'duration': duration,
+            'order': rank
+        })
+        results.append({'filename': file.filename, 'success': True})
+        rank += 1
     
+    added_tracks = insert_tracks(rows)
     db.session.commit()
     
-    # Обновляем ID после коммита
-    for i, track_data in enumerate(added_tracks):
-        track_data['id'] = Track.query.filter_by(playlist_id=playlist_id, order=max_order - len(added_tracks) + i + 1).first().id
+    added = iter(added_tracks)
+    for result in results:
+        if result['success']:
+            result['track'] = next(added)
     
     return jsonify({
         'success': True,
         'tracks': added_tracks,
-        'errors': errors,
+        'results': results,
+        'errors': [f"{r['filename']}: {r['error']}" for r in results if not r['success']],
         'added_count': len(added_tracks)
     })
 
@@ -940,33 +1271,35 @@ def add_tracks_from_cloud(playlist_id):
     if not token:
         return jsonify({'error': 'Яндекс.Диск не подключен'}), 401
     
-    added_count = 0
-    max_order = db.session.query(db.func.max(Track.order)).filter_by(playlist_id=playlist_id).scalar() or 0
+    # Файлы пользователя одним IN-запросом, треки - в порядке file_ids
+    cloud_files = {f.id: f for f in CloudFile.query.filter(
+        CloudFile.id.in_(file_ids), CloudFile.user_id == current_user.id)}
+    rows = []
+    rank = next_rank(Track, Track.playlist_id, playlist_id)
     
     for file_id in file_ids:
-        cloud_file = CloudFile.query.filter_by(id=file_id, user_id=current_user.id).first()
+        cloud_file = cloud_files.get(file_id)
         if not cloud_file:
             continue
         
-        max_order += 1
-        
         # Создаём трек с ссылкой на облачный файл
-        track = Track(
-            playlist_id=playlist_id,
-            title=cloud_file.title or cloud_file.filename,
-            artist=cloud_file.artist or 'Неизвестный исполнитель',
-            url=f'cloud:{cloud_file.id}',  # Специальный формат для облачных файлов
-            duration=cloud_file.duration or 0,
-            order=max_order
-        )
-        db.session.add(track)
-        added_count += 1
+        rows.append({
+            'playlist_id': playlist_id,
+            'title': cloud_file.title or cloud_file.filename,
+            'artist': cloud_file.artist or 'Неизвестный исполнитель',
+            'url': f'cloud:{cloud_file.id}',  # Специальный формат для облачных файлов
+            'duration': cloud_file.duration or 0,
+            'order': rank
+        })
+        rank += 1
     
+    added_tracks = insert_tracks(rows)
     db.session.commit()
     
     return jsonify({
         'success': True,
-        'added': added_count
+        'added': len(added_tracks),
+        'tracks': added_tracks
     })
 
 @app.route('/api/tracks/<int:track_id>', methods=['PUT'])
@@ -980,12 +1313,19 @@ def update_track(track_id):
         track.title = data['title']
     if 'artist' in data:
         track.artist = data['artist']
+    if 'after_id' in data:
+        # Перетаскивание: встать после трека after_id (null - в начало), меняется одна строка
+        try:
+            move(track, Track.playlist_id, data['after_id'])
+        except LookupError:
+            return jsonify({'error': 'Трек after_id не найден в этом плейлисте'}), 400
     
     db.session.commit()
     return jsonify({'success': True, 'track': {
         'id': track.id,
         'title': track.title,
-        'artist': track.artist
+        'artist': track.artist,
+        'order': track.order
     }})
 
 @app.route('/api/tracks/<int:track_id>', methods=['DELETE'])
@@ -1030,6 +1370,7 @@ def get_notes():
 
 @app.route('/api/notes', methods=['POST'])
 @login_required
+@idempotent
 def create_note():
     data = request.json
     note = Note(
@@ -1081,6 +1422,9 @@ def update_profile():
     current_user.avatar_url = data.get('avatar_url', current_user.avatar_url)
     
     db.session.commit()
+    leaderboards.update_user(
+        current_user.id, username=current_user.username, name=current_user.name, avatar_url=current_user.avatar_url
+    )
     return jsonify({'success': True})
 
 # ==================== API: ФОКУС СЕССИЯ ====================
@@ -1103,9 +1447,18 @@ def start_focus():
 @login_required
 def end_focus(session_id):
     focus = FocusSession.query.filter_by(id=session_id, user_id=current_user.id).first_or_404()
+    was_completed = focus.is_completed
+    was_ended = focus.ended_at is not None
     focus.ended_at = datetime.utcnow()
     focus.is_completed = request.json.get('completed', False)
+    if not was_ended:
+        finish_tracking(focus)
+    totals = []
+    if focus.is_completed and not was_completed:
+        totals = add_completed_session(current_user.id, focus)
     db.session.commit()
+    stats_cache.invalidate(current_user.id, 'focus')
+    offer_focus_totals(totals)
     return jsonify({'success': True})
 
 # ==================== API: ПОИСК ПОЛЬЗОВАТЕЛЕЙ ====================
@@ -1113,19 +1466,18 @@ def end_focus(session_id):
 @app.route('/api/users/search')
 @login_required
 def search_users():
-    query = request.args.get('q', '')
+    query = request.args.get('q', '').strip().lstrip('@')
     if len(query) < 2:
         return jsonify([])
     
-    users = User.query.filter(
-        (User.username.ilike(f'%{query}%')) | (User.name.ilike(f'%{query}%'))
-    ).filter(User.id != current_user.id).limit(10).all()
+    # Точные совпадения, затем префиксы, затем подстроки; заблокированные скрыты
+    users = find_users(db.session, current_user.id, query, limit=10)
     
     return jsonify([{
-        'id': u.id,
-        'username': u.username,
-        'name': u.name,
-        'avatar_url': u.avatar_url
+        'id': u['id'],
+        'username': u['username'],
+        'name': u['name'],
+        'avatar_url': u['avatar_url']
     } for u in users])
 
 # ==================== API: ЧАТЫ ====================
@@ -1134,27 +1486,25 @@ def search_users():
 @login_required
 def get_chats():
     """Получить все чаты пользователя"""
-    chats = Chat.query.filter(Chat.members.any(id=current_user.id)).all()
-    result = []
+    # Один запрос: сводка чата + счётчик участника + последнее сообщение, сортировка в SQL
+    rows = db.session.query(Chat, ChatMember.unread_count, Message)\
+        .join(ChatMember, db.and_(ChatMember.chat_id == Chat.id, ChatMember.user_id == current_user.id))\
+        .outerjoin(Message, Message.id == Chat.last_message_id)\
+        .order_by(Chat.last_activity_at.desc())\
+        .all()
+    
+    # Собеседники личных чатов - одним запросом
+    other_users = {}
+    private_ids = [chat.id for chat, _, _ in rows if not chat.is_group]
+    if private_ids:
+        for chat_id, user in db.session.query(ChatMember.chat_id, User)\
+                .join(User, User.id == ChatMember.user_id)\
+                .filter(ChatMember.chat_id.in_(private_ids), ChatMember.user_id != current_user.id):
+            other_users[chat_id] = user
     
-    for chat in chats:
-        # Получаем последнее сообщение
-        last_message = Message.query.filter_by(chat_id=chat.id).order_by(Message.created_at.desc()).first()
-        
-        # Считаем непрочитанные
-        unread_count = Message.query.filter(
-            Message.chat_id == chat.id,
-            Message.sender_id != current_user.id,
-            Message.is_read == False
-        ).count()
-        
-        # Для личных чатов получаем собеседника
-        other_user = None
-        if not chat.is_group:
-            for member in chat.members:
-                if member.id != current_user.id:
-                    other_user = member
-                    break
+    result = []
+    for chat, unread_count, last_message in rows:
+        other_user = other_users.get(chat.id)
         
         result.append({
             'id': chat.id,
@@ -1163,22 +1513,44 @@ def get_chats():
             'chat_type': chat.chat_type or ('group' if chat.is_group else 'private'),
             'avatar': other_user.avatar_url if other_user else (chat.avatar_url or None),
             'avatar_letter': (other_user.name or other_user.username)[0].upper() if other_user else (chat.name[0].upper() if chat.name else 'Г'),
-            'members_count': len(chat.members),
+            'members_count': chat.member_count or 0,
             'last_message': {
-                'content': last_message.content if last_message else None,
-                'sender_id': last_message.sender_id if last_message else None,
-                'created_at': last_message.created_at.isoformat() if last_message else None,
-                'is_mine': last_message.sender_id == current_user.id if last_message else False
+                'content': last_message.content,
+                'sender_id': last_message.sender_id,
+                'created_at': last_message.created_at.isoformat(),
+                'is_mine': last_message.sender_id == current_user.id
             } if last_message else None,
-            'unread_count': unread_count,
+            'unread_count': unread_count or 0,
             'other_user_id': other_user.id if other_user else None,
             'other_username': other_user.username if other_user else None
         })
     
-    # Сортируем по последнему сообщению
-    result.sort(key=lambda x: x['last_message']['created_at'] if x['last_message'] else '', reverse=True)
     return jsonify(result)
 
+@app.route('/api/chats/search', methods=['GET'])
+@login_required
+def search_chat_messages():
+    """Полнотекстовый поиск по сообщениям своих чатов"""
+    query = request.args.get('q', '').strip()
+    if len(query) < 2:
+        return jsonify({'results': [], 'has_more': False})
+    
+    limit = max(1, min(request.args.get('limit', 20, type=int), 50))
+    results, has_more = search_messages(
+        db.session,
+        current_user.id,
+        query,
+        limit=limit,
+        chat_id=request.args.get('chat_id', type=int),
+        after_rank=request.args.get('after_rank', type=float),
+        after_id=request.args.get('after_id', type=int)
+    )
+    
+    # Следующая страница: ?after_rank=...&after_id=... из последнего результата
+    next_page = {'after_rank': results[-1]['rank'], 'after_id': results[-1]['id']} if has_more else None
+    return jsonify({'results': results, 'has_more': has_more, 'next': next_page})
+
+
 @app.route('/api/chats', methods=['POST'])
 @login_required
 def create_chat():
@@ -1208,14 +1580,11 @@ def create_chat():
             if not existing:
                 chat.username = data['username']
         
-        chat.members.append(current_user)
         db.session.add(chat)
         db.session.flush()
         
         # Добавляем владельца как админа
-        from models import ChatMember
-        member = ChatMember(chat_id=chat.id, user_id=current_user.id, role='owner')
-        db.session.add(member)
+        add_chat_membership(chat, current_user.id, role='owner')
         
     elif chat_type == 'group' or data.get('is_group'):
         # Групповой чат
@@ -1239,43 +1608,40 @@ def create_chat():
             if not existing:
                 chat.username = data['username']
         
-        chat.members.append(current_user)
-        for user_id in data.get('member_ids', []):
-            user = User.query.get(user_id)
-            if user:
-                chat.members.append(user)
-        
         db.session.add(chat)
         db.session.flush()
         
         # Добавляем владельца
-        from models import ChatMember
-        member = ChatMember(chat_id=chat.id, user_id=current_user.id, role='owner')
-        db.session.add(member)
+        add_chat_membership(chat, current_user.id, role='owner')
         
-        # Добавляем остальных участников
-        for user_id in data.get('member_ids', []):
-            m = ChatMember(chat_id=chat.id, user_id=user_id, role='member')
-            db.session.add(m)
+        # Добавляем остальных участников (существующих и без повторов)
+        member_ids = {int(user_id) for user_id in data.get('member_ids', [])} - {current_user.id}
+        if member_ids:
+            for (user_id,) in db.session.query(User.id).filter(User.id.in_(member_ids)):
+                add_chat_membership(chat, user_id)
     else:
         # Личный чат - проверяем, нет ли уже такого
         other_user_id = data['user_id']
         other_user = User.query.get_or_404(other_user_id)
         
         # Ищем существующий личный чат
-        existing_chat = Chat.query.filter(
-            Chat.is_group == False,
-            Chat.members.any(id=current_user.id),
-            Chat.members.any(id=other_user_id)
-        ).first()
+        mine = db.aliased(ChatMember)
+        theirs = db.aliased(ChatMember)
+        existing_chat = Chat.query\
+            .join(mine, db.and_(mine.chat_id == Chat.id, mine.user_id == current_user.id))\
+            .join(theirs, db.and_(theirs.chat_id == Chat.id, theirs.user_id == other_user_id))\
+            .filter(Chat.is_group == False)\
+            .first()
         
         if existing_chat:
             return jsonify({'success': True, 'id': existing_chat.id, 'existing': True})
         
         chat = Chat(is_group=False, chat_type='private')
-        chat.members.append(current_user)
-        chat.members.append(other_user)
         db.session.add(chat)
+        db.session.flush()
+        
+        add_chat_membership(chat, current_user.id)
+        add_chat_membership(chat, other_user.id)
     
     db.session.commit()
     return jsonify({'success': True, 'id': chat.id})
@@ -1288,9 +1654,8 @@ def update_chat_settings(chat_id):
     chat = Chat.query.get_or_404(chat_id)
     
     # Проверяем права (только владелец или админ)
-    from models import ChatMember
-    membership = ChatMember.query.filter_by(chat_id=chat_id, user_id=current_user.id).first()
-    if not membership or membership.role not in ['owner', 'admin']:
+    access = get_chat_access(chat_id, current_user.id)
+    if not access or access['role'] not in ['owner', 'admin']:
         if chat.owner_id != current_user.id:
             return jsonify({'error': 'Нет прав'}), 403
     
@@ -1330,9 +1695,8 @@ def upload_chat_avatar(chat_id):
     chat = Chat.query.get_or_404(chat_id)
     
     # Проверяем права
-    from models import ChatMember
-    membership = ChatMember.query.filter_by(chat_id=chat_id, user_id=current_user.id).first()
-    if not membership or membership.role not in ['owner', 'admin']:
+    access = get_chat_access(chat_id, current_user.id)
+    if not access or access['role'] not in ['owner', 'admin']:
         if chat.owner_id != current_user.id:
             return jsonify({'error': 'Нет прав'}), 403
     
@@ -1383,24 +1747,24 @@ def uploaded_chat_avatar(filename):
 @login_required
 def get_chat_members(chat_id):
     """Получить список участников чата"""
-    chat = Chat.query.get_or_404(chat_id)
-    if current_user not in chat.members:
+    Chat.query.get_or_404(chat_id)
+    if get_chat_access(chat_id, current_user.id) is None:
         return jsonify({'error': 'Нет доступа'}), 403
     
-    from models import ChatMember
-    members = []
-    for user in chat.members:
-        membership = ChatMember.query.filter_by(chat_id=chat_id, user_id=user.id).first()
-        members.append({
-            'id': user.id,
-            'username': user.username,
-            'name': user.name,
-            'avatar_url': user.avatar_url,
-            'role': membership.role if membership else 'member',
-            'can_send_messages': membership.can_send_messages if membership else True
-        })
+    rows = db.session.query(ChatMember, User)\
+        .join(User, User.id == ChatMember.user_id)\
+        .filter(ChatMember.chat_id == chat_id)\
+        .order_by(ChatMember.id)\
+        .all()
     
-    return jsonify(members)
+    return jsonify([{
+        'id': user.id,
+        'username': user.username,
+        'name': user.name,
+        'avatar_url': user.avatar_url,
+        'role': membership.role or 'member',
+        'can_send_messages': membership.can_send_messages if membership.can_send_messages is not None else True
+    } for membership, user in rows])
 
 
 @app.route('/api/chats/<int:chat_id>/members', methods=['POST'])
@@ -1410,9 +1774,8 @@ def add_chat_member(chat_id):
     chat = Chat.query.get_or_404(chat_id)
     
     # Проверяем права
-    from models import ChatMember
-    membership = ChatMember.query.filter_by(chat_id=chat_id, user_id=current_user.id).first()
-    can_add = (membership and membership.role in ['owner', 'admin']) or chat.members_can_add or chat.owner_id == current_user.id
+    access = get_chat_access(chat_id, current_user.id)
+    can_add = (access and access['role'] in ['owner', 'admin']) or chat.members_can_add or chat.owner_id == current_user.id
     
     if not can_add:
         return jsonify({'error': 'Нет прав добавлять участников'}), 403
@@ -1420,14 +1783,9 @@ def add_chat_member(chat_id):
     data = request.json
     user = User.query.get_or_404(data['user_id'])
     
-    if user in chat.members:
+    if not join_chat(chat, user.id):
         return jsonify({'error': 'Пользователь уже в чате'}), 400
     
-    chat.members.append(user)
-    member = ChatMember(chat_id=chat_id, user_id=user.id, role='member')
-    db.session.add(member)
-    db.session.commit()
-    
     return jsonify({'success': True})
 
 
@@ -1437,19 +1795,15 @@ def remove_chat_member(chat_id, user_id):
     """Удалить участника из группы/канала"""
     chat = Chat.query.get_or_404(chat_id)
     
-    from models import ChatMember
-    membership = ChatMember.query.filter_by(chat_id=chat_id, user_id=current_user.id).first()
+    access = get_chat_access(chat_id, current_user.id)
     
     # Можно удалить себя или если есть права
     if user_id != current_user.id:
-        if not membership or membership.role not in ['owner', 'admin']:
+        if not access or access['role'] not in ['owner', 'admin']:
             if chat.owner_id != current_user.id:
                 return jsonify({'error': 'Нет прав'}), 403
     
-    user = User.query.get_or_404(user_id)
-    if user in chat.members:
-        chat.members.remove(user)
-        ChatMember.query.filter_by(chat_id=chat_id, user_id=user_id).delete()
+    if remove_chat_membership(chat, user_id):
         db.session.commit()
     
     return jsonify({'success': True})
@@ -1465,14 +1819,14 @@ def update_member_role(chat_id, user_id):
     if chat.owner_id != current_user.id:
         return jsonify({'error': 'Только владелец может менять роли'}), 403
     
-    from models import ChatMember
-    membership = ChatMember.query.filter_by(chat_id=chat_id, user_id=user_id).first()
+    membership = ChatMember.get(chat_id, user_id)
     if not membership:
         return jsonify({'error': 'Участник не найден'}), 404
     
     data = request.json
     if data['role'] in ['admin', 'member']:
         membership.role = data['role']
+        invalidate_chat_access(chat_id, user_id)
         db.session.commit()
     
     return jsonify({'success': True})
@@ -1484,15 +1838,9 @@ def join_chat_by_link(invite_link):
     """Присоединиться к чату по пригласительной ссылке"""
     chat = Chat.query.filter_by(invite_link=invite_link).first_or_404()
     
-    if current_user in chat.members:
+    if not join_chat(chat, current_user.id):
         return jsonify({'success': True, 'id': chat.id, 'already_member': True})
     
-    chat.members.append(current_user)
-    from models import ChatMember
-    member = ChatMember(chat_id=chat.id, user_id=current_user.id, role='member')
-    db.session.add(member)
-    db.session.commit()
-    
     return jsonify({'success': True, 'id': chat.id})
 
 
@@ -1502,9 +1850,8 @@ def regenerate_invite_link(chat_id):
     """Перегенерировать пригласительную ссылку"""
     chat = Chat.query.get_or_404(chat_id)
     
-    from models import ChatMember
-    membership = ChatMember.query.filter_by(chat_id=chat_id, user_id=current_user.id).first()
-    if not membership or membership.role not in ['owner', 'admin']:
+    access = get_chat_access(chat_id, current_user.id)
+    if not access or access['role'] not in ['owner', 'admin']:
         if chat.owner_id != current_user.id:
             return jsonify({'error': 'Нет прав'}), 403
     
@@ -1520,21 +1867,16 @@ def get_chat(chat_id):
     """Получить информацию о чате"""
     chat = Chat.query.get_or_404(chat_id)
     
-    # Проверяем, что пользователь участник чата
-    if current_user not in chat.members:
+    # Проверяем, что пользователь участник чата и получаем его роль
+    access = get_chat_access(chat_id, current_user.id)
+    if access is None:
         return jsonify({'error': 'Доступ запрещён'}), 403
+    user_role = access['role']
     
+    members = chat.members
     other_user = None
     if not chat.is_group:
-        for member in chat.members:
-            if member.id != current_user.id:
-                other_user = member
-                break
-    
-    # Получаем роль текущего пользователя
-    from models import ChatMember
-    membership = ChatMember.query.filter_by(chat_id=chat_id, user_id=current_user.id).first()
-    user_role = membership.role if membership else 'member'
+        other_user = next((m for m in members if m.id != current_user.id), None)
     
     return jsonify({
         'id': chat.id,
@@ -1558,7 +1900,7 @@ def get_chat(chat_id):
             'username': m.username,
             'name': m.name,
             'avatar_url': m.avatar_url
-        } for m in chat.members],
+        } for m in members],
         'other_user': {
             'id': other_user.id,
             'username': other_user.username,
@@ -1567,66 +1909,272 @@ def get_chat(chat_id):
         } if other_user else None
     })
 
-@app.route('/api/chats/<int:chat_id>/messages', methods=['GET'])
+def get_chat_access(chat_id, user_id):
+    """Роль и права участника из кэша; None, если пользователь не в чате.
+    Отказ не кэшируется: вступление через другой воркер видно сразу."""
+    key = (chat_id, user_id)
+    access = chat_access_cache.get(key)
+    if access is MISSING:
+        membership = ChatMember.get(chat_id, user_id)
+        if membership is None:
+            return None
+        access = {
+            'role': membership.role or 'member',
+            'can_send_messages': membership.can_send_messages if membership.can_send_messages is not None else True
+        }
+        chat_access_cache.set(key, access)
+    return access
+
+
+def invalidate_chat_access(chat_id, user_id=None):
+    """Сбросить кэш прав после коммита (user_id=None - всех участников чата).
+    До коммита параллельный запрос успел бы закэшировать старое значение."""
+    db.session.info.setdefault('stale_chat_access', set()).add((chat_id, user_id))
+
+
+@sa_event.listens_for(db.session, 'after_commit')
+def drop_stale_chat_access(session):
+    for chat_id, user_id in session.info.pop('stale_chat_access', ()):
+        if user_id is None:
+            chat_access_cache.delete_where(lambda key: key[0] == chat_id)
+        else:
+            chat_access_cache.delete((chat_id, user_id))
+
+
+@sa_event.listens_for(db.session, 'after_rollback')
+def forget_stale_chat_access(session):
+    session.info.pop('stale_chat_access', None)
+
+
+def add_chat_membership(chat, user_id, role='member'):
+    """Добавить участника: история до вступления считается прочитанной"""
+    member = ChatMember(chat_id=chat.id, user_id=user_id, role=role, last_read_message_id=chat.last_message_id or 0)
+    db.session.add(member)
+    chat.member_count = (chat.member_count or 0) + 1
+    invalidate_chat_access(chat.id, user_id)
+    return member
+
+
+def join_chat(chat, user_id):
+    """Вступить в чат с коммитом; False, если пользователь уже участник.
+    Проверка по БД, а не по кэшу; одновременное вступление упирается в уникальный индекс."""
+    if ChatMember.get(chat.id, user_id) is not None:
+        return False
+    add_chat_membership(chat, user_id)
+    try:
+        db.session.commit()
+    except IntegrityError:
+        db.session.rollback()
+        return False
+    return True
+
+
+def remove_chat_membership(chat, user_id):
+    """Удалить участника; возвращает True, если он был в чате"""
+    removed = ChatMember.query.filter_by(chat_id=chat.id, user_id=user_id).delete()
+    if removed:
+        chat.member_count = max((chat.member_count or 0) - removed, 0)
+    invalidate_chat_access(chat.id, user_id)
+    return bool(removed)
+
+
+def advance_read_cursor(membership, message_id):
+    """Сдвинуть курсор прочтения вперёд; возвращает True, только если он сдвинулся"""
+    if not message_id or (membership.last_read_message_id or 0) >= message_id:
+        return False
+    membership.last_read_message_id = message_id
+    # Обычно курсор доходит до конца чата, и диапазон после него пуст
+    membership.unread_count = Message.query.filter(
+        Message.chat_id == membership.chat_id,
+        Message.sender_id != membership.user_id,
+        Message.id > message_id
+    ).count()
+    return True
+
+
+def serialize_message(m, viewer_id=None, peers_read_upto=0):
+    """
+    Сериализовать сообщение для API и потока событий. Без viewer_id - общая для всех
+    получателей часть (без is_mine и is_read): её рассылает поток событий.
+    """
+    msg_data = {
+        'id': m.id,
+        'chat_id': m.chat_id,
+        'content': m.content,
+        'sender_id': m.sender_id,
+        'sender_name': m.sender.name or m.sender.username,
+        'sender_username': m.sender.username,
+        'sender_avatar': m.sender.avatar_url,
+        'created_at': m.created_at.isoformat(),
+        'edited_at': m.edited_at.isoformat() if m.edited_at else None,
+        'reply_to': None
+    }
+    if viewer_id is not None:
+        msg_data['is_read'] = m.id <= peers_read_upto if m.sender_id == viewer_id else True
+        msg_data['is_mine'] = m.sender_id == viewer_id
+    if m.reply_to:
+        msg_data['reply_to'] = {
+            'id': m.reply_to.id,
+            'content': m.reply_to.content[:100],
+            'sender_name': m.reply_to.sender.name or m.reply_to.sender.username
+        }
+    return msg_data
+
+
+def message_query():
+    """Запрос сообщений сразу с отправителями и цитатами (без ленивой загрузки на каждое сообщение)"""
+    return Message.query.options(
+        joinedload(Message.sender),
+        selectinload(Message.reply_to).joinedload(Message.sender)
+    )
+
+
+def messages_after(chat_id, after_id, limit=50):
+    """
+    Новые сообщения чата после after_id для потока событий; соединение сразу возвращается в пул.
+    Сначала дешёвая проверка Chat.last_message_id по первичному ключу - строки читаются,
+    только если в чате правда есть что-то новее.
+    """
+    last_message_id = db.session.query(Chat.last_message_id).filter(Chat.id == chat_id).scalar()
+    result = []
+    if last_message_id and last_message_id > after_id:
+        messages = message_query().filter(Message.chat_id == chat_id, Message.id > after_id)\
+            .order_by(Message.id).limit(limit).all()
+        result = [serialize_message(m) for m in messages]
+    db.session.remove()
+    return result
+
+
+@app.route('/api/chats/<int:chat_id>/events')
 @login_required
-def get_messages(chat_id):
-    """Получить сообщения чата"""
+def chat_events(chat_id):
+    """Поток новых, изменённых и удалённых сообщений чата (Server-Sent Events)"""
+    # Поток занимает воркер, пока открыт: только при асинхронных воркерах, иначе клиент опрашивает after_id
+    if not app.config['CHAT_EVENTS_ENABLED']:
+        return jsonify({'error': 'Поток событий отключён'}), 404
+    
     chat = Chat.query.get_or_404(chat_id)
     
-    if current_user not in chat.members:
+    if get_chat_access(chat_id, current_user.id) is None:
         return jsonify({'error': 'Доступ запрещён'}), 403
     
-    # Пагинация
-    page = request.args.get('page', 1, type=int)
-    per_page = request.args.get('per_page', 50, type=int)
+    user_id = current_user.id
+    last_id = chat.last_message_id or 0
+    poll_interval = app.config['CHAT_EVENTS_POLL']
+    heartbeat = app.config['CHAT_EVENTS_HEARTBEAT']
+    max_seconds = app.config['CHAT_EVENTS_MAX_SECONDS']
     
-    messages = Message.query.filter_by(chat_id=chat_id)\
-        .order_by(Message.created_at.desc())\
-        .paginate(page=page, per_page=per_page, error_out=False)
+    # Поток живёт долго - возвращаем соединение с БД в пул до начала стриминга
+    db.session.remove()
+    q = chat_broker.subscribe(chat_id)
     
-    # Помечаем сообщения как прочитанные
-    Message.query.filter(
-        Message.chat_id == chat_id,
-        Message.sender_id != current_user.id,
-        Message.is_read == False
-    ).update({'is_read': True})
-    db.session.commit()
+    @stream_with_context
+    def generate():
+        nonlocal last_id
+        now = time.monotonic()
+        deadline, next_poll, next_heartbeat = now + max_seconds, now + poll_interval, now + heartbeat
+        try:
+            yield 'retry: 3000\n\n'
+            while True:
+                now = time.monotonic()
+                if now >= deadline:
+                    break
+                if now >= next_poll:
+                    # Брокер видит только этот процесс: сообщения через другие воркеры берём из БД
+                    for message_data in messages_after(chat_id, last_id):
+                        last_id = message_data['id']
+                        yield format_sse('message_new', dict(message_data, is_mine=message_data['sender_id'] == user_id))
+                    next_poll = now + poll_interval
+                if now >= next_heartbeat:
+                    # Исключённый из чата участник больше не получает событий
+                    if get_chat_access(chat_id, user_id) is None:
+                        break
+                    db.session.remove()
+                    yield ': ping\n\n'
+                    next_heartbeat = now + heartbeat
+                
+                try:
+                    event, data = q.get(timeout=max(0, min(next_poll, next_heartbeat) - now))
+                except queue.Empty:
+                    continue
+                if event is None:
+                    break
+                if event == 'typing' and data['user_id'] == user_id:
+                    continue
+                if event == 'message_new':
+                    if data['id'] <= last_id:
+                        continue  # Уже отдано опросом БД
+                    last_id = data['id']
+                if 'sender_id' in data:
+                    data = dict(data, is_mine=data['sender_id'] == user_id)
+                yield format_sse(event, data)
+        finally:
+            chat_broker.unsubscribe(chat_id, q)
+            db.session.remove()
+    
+    return Response(generate(), mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no'
+    })
+
+@app.route('/api/chats/<int:chat_id>/messages', methods=['GET'])
+@login_required
+def get_messages(chat_id):
+    """Получить сообщения чата"""
+    Chat.query.get_or_404(chat_id)
     
-    def format_message(m):
-        msg_data = {
-            'id': m.id,
-            'content': m.content,
-            'sender_id': m.sender_id,
-            'sender_name': m.sender.name or m.sender.username,
-            'sender_username': m.sender.username,
-            'sender_avatar': m.sender.avatar_url,
-            'created_at': m.created_at.isoformat(),
-            'edited_at': m.edited_at.isoformat() if m.edited_at else None,
-            'is_read': m.is_read,
-            'is_mine': m.sender_id == current_user.id,
-            'reply_to': None
-        }
-        if m.reply_to:
-            msg_data['reply_to'] = {
-                'id': m.reply_to.id,
-                'content': m.reply_to.content[:100],
-                'sender_name': m.reply_to.sender.name or m.reply_to.sender.username
-            }
-        return msg_data
+    membership = ChatMember.get(chat_id, current_user.id)
+    if not membership:
+        return jsonify({'error': 'Доступ запрещён'}), 403
+    
+    per_page = max(1, min(request.args.get('per_page', 50, type=int), 200))
+    after_id = request.args.get('after_id', type=int)
+    before_id = request.args.get('before_id', type=int)
+    
+    if 'page' in request.args:
+        # Старая постраничная выдача (OFFSET + COUNT) для совместимости
+        page = request.args.get('page', 1, type=int)
+        messages = message_query().filter_by(chat_id=chat_id)\
+            .order_by(Message.created_at.desc())\
+            .paginate(page=page, per_page=per_page, error_out=False)
+        items = list(reversed(messages.items))
+        extra = {'has_more': messages.has_next, 'total': messages.total}
+    else:
+        # Keyset-пагинация по id: только сообщения новее after_id или старее before_id, без COUNT
+        query = message_query().filter(Message.chat_id == chat_id)
+        if after_id is not None:
+            rows = query.filter(Message.id > after_id).order_by(Message.id.asc()).limit(per_page + 1).all()
+            items = rows[:per_page]
+        else:
+            if before_id is not None:
+                query = query.filter(Message.id < before_id)
+            rows = query.order_by(Message.id.desc()).limit(per_page + 1).all()
+            items = list(reversed(rows[:per_page]))
+        extra = {'has_more': len(rows) > per_page}
+    
+    # Курсор прочтения двигаем только вперёд - пустой опрос не открывает транзакцию записи
+    if advance_read_cursor(membership, max((m.id for m in items), default=0)):
+        db.session.commit()
+    
+    # Свои сообщения прочитаны, если до них дошёл курсор кого-то из собеседников
+    peers_read_upto = db.session.query(db.func.max(ChatMember.last_read_message_id)).filter(
+        ChatMember.chat_id == chat_id,
+        ChatMember.user_id != current_user.id
+    ).scalar() or 0
     
     return jsonify({
-        'messages': [format_message(m) for m in reversed(messages.items)],
-        'has_more': messages.has_next,
-        'total': messages.total
+        'messages': [serialize_message(m, current_user.id, peers_read_upto) for m in items],
+        **extra
     })
 
 @app.route('/api/chats/<int:chat_id>/messages', methods=['POST'])
 @login_required
+@idempotent
 def send_message(chat_id):
     """Отправить сообщение"""
     chat = Chat.query.get_or_404(chat_id)
     
-    if current_user not in chat.members:
+    if get_chat_access(chat_id, current_user.id) is None:
         return jsonify({'error': 'Доступ запрещён'}), 403
     
     data = request.json
@@ -1643,29 +2191,23 @@ def send_message(chat_id):
         reply_to_id=reply_to_id
     )
     db.session.add(message)
+    db.session.flush()
+    
+    # Сводка чата и счётчики непрочитанных остальных участников
+    chat.last_message_id = message.id
+    chat.last_activity_at = message.created_at
+    ChatMember.query.filter(
+        ChatMember.chat_id == chat_id,
+        ChatMember.user_id != current_user.id
+    ).update({'unread_count': ChatMember.unread_count + 1}, synchronize_session=False)
     db.session.commit()
     
-    response_data = {
-        'success': True,
-        'message': {
-            'id': message.id,
-            'content': message.content,
-            'sender_id': message.sender_id,
-            'sender_name': current_user.name or current_user.username,
-            'created_at': message.created_at.isoformat(),
-            'is_mine': True,
-            'reply_to': None
-        }
-    }
-    
-    if message.reply_to:
-        response_data['message']['reply_to'] = {
-            'id': message.reply_to.id,
-            'content': message.reply_to.content[:100],
-            'sender_name': message.reply_to.sender.name or message.reply_to.sender.username
-        }
+    # Рассылается общая часть: is_mine поток добавляет каждому получателю сам
+    chat_broker.publish(chat_id, 'message_new', serialize_message(message))
+    if typing_store.stop(chat_id, current_user.id):
+        chat_broker.publish(chat_id, 'typing', {'user_id': current_user.id, 'typing': False})
     
-    return jsonify(response_data)
+    return jsonify({'success': True, 'message': serialize_message(message, current_user.id)})
 
 @app.route('/api/chats/<int:chat_id>/messages/<int:message_id>', methods=['DELETE'])
 @login_required
@@ -1673,7 +2215,24 @@ def delete_message(chat_id, message_id):
     """Удалить сообщение"""
     message = Message.query.filter_by(id=message_id, chat_id=chat_id, sender_id=current_user.id).first_or_404()
     db.session.delete(message)
+    
+    # Сообщение ещё не прочитано у тех, чей курсор до него не дошёл
+    ChatMember.query.filter(
+        ChatMember.chat_id == chat_id,
+        ChatMember.user_id != current_user.id,
+        ChatMember.last_read_message_id < message_id,
+        ChatMember.unread_count > 0
+    ).update({'unread_count': ChatMember.unread_count - 1}, synchronize_session=False)
+    
+    chat = message.chat
+    if chat.last_message_id == message_id:
+        previous = Message.query.filter(Message.chat_id == chat_id, Message.id < message_id)\
+            .order_by(Message.id.desc()).first()
+        chat.last_message_id = previous.id if previous else None
+        chat.last_activity_at = previous.created_at if previous else chat.created_at
+    
     db.session.commit()
+    chat_broker.publish(chat_id, 'message_deleted', {'id': message_id})
     return jsonify({'success': True})
 
 @app.route('/api/chats/<int:chat_id>', methods=['DELETE'])
@@ -1682,13 +2241,13 @@ def delete_chat(chat_id):
     """Удалить чат (или выйти из группового)"""
     chat = Chat.query.get_or_404(chat_id)
     
-    if current_user not in chat.members:
+    if get_chat_access(chat_id, current_user.id) is None:
         return jsonify({'error': 'Доступ запрещён'}), 403
     
     if chat.is_group:
         # Выходим из группы
-        chat.members.remove(current_user)
-        if len(chat.members) == 0:
+        remove_chat_membership(chat, current_user.id)
+        if chat.member_count == 0:
             Message.query.filter_by(chat_id=chat_id).delete()
             db.session.delete(chat)
     else:
@@ -1696,6 +2255,7 @@ def delete_chat(chat_id):
         Message.query.filter_by(chat_id=chat_id).delete()
         db.session.delete(chat)
     
+    invalidate_chat_access(chat_id)
     db.session.commit()
     return jsonify({'success': True})
 
@@ -1703,19 +2263,27 @@ def delete_chat(chat_id):
 @login_required
 def mark_chat_read(chat_id):
     """Пометить все сообщения чата как прочитанные"""
-    chat = Chat.query.get_or_404(chat_id)
+    Chat.query.get_or_404(chat_id)
     
-    if current_user not in chat.members:
+    membership = ChatMember.get(chat_id, current_user.id)
+    if not membership:
         return jsonify({'error': 'Доступ запрещён'}), 403
     
-    Message.query.filter(
-        Message.chat_id == chat_id,
-        Message.sender_id != current_user.id,
-        Message.is_read == False
-    ).update({'is_read': True})
-    db.session.commit()
+    # Можно отметить прочитанным до конкретного сообщения, иначе - до последнего
+    data = request.get_json(silent=True) or {}
+    if not isinstance(data, dict):
+        return jsonify({'error': 'Ожидается JSON-объект'}), 400
+    message_id = db.session.query(db.func.max(Message.id)).filter(Message.chat_id == chat_id).scalar() or 0
+    if data.get('message_id'):
+        try:
+            message_id = min(int(data['message_id']), message_id)
+        except (TypeError, ValueError):
+            return jsonify({'error': 'message_id должен быть числом'}), 400
+    
+    if advance_read_cursor(membership, message_id):
+        db.session.commit()
     
-    return jsonify({'success': True})
+    return jsonify({'success': True, 'last_read_message_id': membership.last_read_message_id or 0})
 
 @app.route('/api/chats/<int:chat_id>/messages/<int:message_id>', methods=['PUT'])
 @login_required
@@ -1732,6 +2300,12 @@ def edit_message(chat_id, message_id):
     message.edited_at = datetime.utcnow()
     db.session.commit()
     
+    chat_broker.publish(chat_id, 'message_edited', {
+        'id': message.id,
+        'content': message.content,
+        'edited_at': message.edited_at.isoformat()
+    })
+    
     return jsonify({
         'success': True,
         'message': {
@@ -1748,10 +2322,12 @@ def get_user_profile(user_id):
     user = User.query.get_or_404(user_id)
     
     # Проверяем онлайн-статус (онлайн если был активен в последние 5 минут)
+    # Свежий пинг этого процесса может быть ещё не записан в БД
+    last_seen = max(filter(None, [presence.last_seen(user.id), user.last_seen]), default=None)
     is_online = False
     last_seen_text = ''
-    if user.last_seen:
-        diff = (datetime.utcnow() - user.last_seen).total_seconds()
+    if last_seen:
+        diff = (datetime.utcnow() - last_seen).total_seconds()
         is_online = diff < 300  # 5 минут
         if not is_online:
             if diff < 3600:
@@ -1759,7 +2335,7 @@ def get_user_profile(user_id):
             elif diff < 86400:
                 last_seen_text = f'был(а) {int(diff // 3600)} ч. назад'
             else:
-                last_seen_text = f'был(а) {user.last_seen.strftime("%d.%m.%Y")}'
+                last_seen_text = f'был(а) {last_seen.strftime("%d.%m.%Y")}'
     
     return jsonify({
         'id': user.id,
@@ -1775,19 +2351,40 @@ def get_user_profile(user_id):
 @app.route('/api/ping', methods=['POST'])
 @login_required
 def ping_online():
-    """Обновить онлайн-статус пользователя"""
-    current_user.last_seen = datetime.utcnow()
-    db.session.commit()
+    """Обновить онлайн-статус пользователя (без записи в БД на каждый пинг)"""
+    presence.touch(current_user.id)
     return jsonify({'success': True})
 
 @app.route('/api/chats/<int:chat_id>/typing', methods=['POST'])
 @login_required
 def set_typing(chat_id):
     """Установить статус 'печатает' (хранится в памяти, не в БД)"""
-    # В реальном приложении это делается через WebSocket
-    # Здесь просто возвращаем успех
+    if get_chat_access(chat_id, current_user.id) is None:
+        return jsonify({'error': 'Доступ запрещён'}), 403
+    
+    name = current_user.name or current_user.username
+    typing_store.start(chat_id, current_user.id, name)
+    chat_broker.publish(chat_id, 'typing', {
+        'user_id': current_user.id,
+        'name': name,
+        'typing': True,
+        'ttl': typing_store.ttl
+    })
     return jsonify({'success': True})
 
+@app.route('/api/chats/<int:chat_id>/typing', methods=['GET'])
+@login_required
+def get_typing(chat_id):
+    """Кто сейчас печатает в чате (без обращения к таблицам сообщений)"""
+    if get_chat_access(chat_id, current_user.id) is None:
+        return jsonify({'error': 'Доступ запрещён'}), 403
+    
+    return jsonify({'users': [
+        {'id': user_id, 'name': name}
+        for user_id, name in typing_store.typing_users(chat_id)
+        if user_id != current_user.id
+    ]})
+
 # ==================== API: НАСТРОЙКИ ПРОФИЛЯ ====================
 
 @app.route('/api/profile/settings', methods=['GET'])
@@ -1842,6 +2439,9 @@ def update_profile_settings():
             current_user.privacy_playlists = privacy['playlists']
     
     db.session.commit()
+    leaderboards.update_user(
+        current_user.id, username=current_user.username, name=current_user.name, avatar_url=current_user.avatar_url
+    )
     return jsonify({'success': True})
 
 # ==================== API: БЛОКИРОВКА ПОЛЬЗОВАТЕЛЕЙ ====================
@@ -1987,6 +2587,7 @@ def get_user_pinned_playlist(user_id):
 
 @app.route('/api/focus/tree', methods=['GET'])
 @login_required
+@cached_stats('focus', should_cache=lambda data: not data['health_changed'])
 def get_focus_tree():
     """Получить дерево концентрации"""
     tree = FocusTree.query.filter_by(user_id=current_user.id).first()
@@ -1995,28 +2596,12 @@ def get_focus_tree():
         db.session.add(tree)
         db.session.commit()
     
-    # Проверяем, сколько дней прошло без сессий - дерево чахнет
-    health_changed = False
-    if tree.last_session_date:
-        today = datetime.utcnow().date()
-        days_without_session = (today - tree.last_session_date).days
-        
-        if days_without_session > 1:
-            # Уменьшаем здоровье за каждый пропущенный день (кроме первого)
-            health_loss = (days_without_session - 1) * 5  # -5 HP за каждый день без сессии
-            new_health = max(10, tree.health - health_loss)  # Минимум 10 HP
-            
-            if new_health != tree.health:
-                tree.health = new_health
-                health_changed = True
-            
-            # Сбрасываем streak если пропущено больше 1 дня
-            if days_without_session > 1 and tree.streak_days > 0:
-                tree.streak_days = 0
-                health_changed = True
-        
-        if health_changed:
-            db.session.commit()
+    # Увядание записывает ночная задача decay-focus-trees; если она ещё не отработала
+    # сегодня, показываем значения с учётом пропущенных дней, ничего не записывая.
+    # Флаг анимации - только когда увядание применено в этом ответе, а не записано ранее
+    today = datetime.utcnow().date()
+    health, streak_days = tree.decayed(today)
+    health_changed = health != tree.health
     
     # Рассчитываем опыт до следующего уровня
     exp_for_next = tree.level * 100
@@ -2025,10 +2610,10 @@ def get_focus_tree():
         'level': tree.level,
         'experience': tree.experience,
         'exp_for_next_level': exp_for_next,
-        'health': tree.health,
+        'health': health,
         'total_focus_minutes': tree.total_focus_minutes,
         'total_sessions': tree.total_sessions,
-        'streak_days': tree.streak_days,
+        'streak_days': streak_days,
         'tree_type': tree.tree_type,
         'garden_level': getattr(tree, 'garden_level', 0),
         'garden_exp': getattr(tree, 'garden_exp', 0),
@@ -2125,21 +2710,28 @@ def end_focus_session(session_id):
     session = FocusSession.query.filter_by(id=session_id, user_id=current_user.id).first_or_404()
     data = request.json
     
+    was_completed = session.is_completed
+    was_ended = session.ended_at is not None
     session.ended_at = datetime.utcnow()
     session.is_completed = data.get('completed', False)
     session.distractions = data.get('distractions', 0)
+    totals = []
+    
+    # Почасовой лог времени: последний интервал сессии
+    if not was_ended:
+        finish_tracking(session)
     
     # Обновляем дерево
     tree = FocusTree.query.filter_by(user_id=current_user.id).first()
     if not tree:
         tree = FocusTree(user_id=current_user.id)
         db.session.add(tree)
+        db.session.flush()  # Применяем значения по умолчанию (опыт, здоровье, счётчики)
+    else:
+        tree.apply_decay(datetime.utcnow().date())  # Увядание, которое ночная задача ещё не записала
     
     # Рассчитываем время сессии
-    if session.started_at and session.ended_at:
-        actual_minutes = int((session.ended_at - session.started_at).total_seconds() / 60)
-    else:
-        actual_minutes = session.duration_minutes
+    actual_minutes = session.actual_minutes()
     
     if session.is_completed:
         # Успешная сессия - дерево растёт
@@ -2152,6 +2744,10 @@ def end_focus_session(session_id):
         tree.total_sessions += 1
         session.tree_growth = exp_gained
         
+        # Агрегаты для статистики и рейтингов (повторное завершение той же сессии не учитываем)
+        if not was_completed:
+            totals = add_completed_session(current_user.id, session)
+        
         # Восстанавливаем здоровье
         tree.health = min(100, tree.health + 5)
         
@@ -2191,34 +2787,16 @@ def end_focus_session(session_id):
         # Незавершённая сессия - дерево страдает
         tree.health = max(0, tree.health - 10 - session.distractions * 5)
     
-    db.session.commit()
-    
-    # Проверяем достижения
+    # Проверяем достижения (только зависящие от сессии, в той же транзакции)
     unlocked = []
     if session.is_completed:
-        unlocked = check_and_unlock_achievements(current_user.id)
-        
-        # Проверяем специальные достижения
-        hour = datetime.utcnow().hour
-        existing = {a.achievement_type for a in Achievement.query.filter_by(user_id=current_user.id).all()}
-        
-        if session.distractions == 0 and 'perfect_session' not in existing:
-            achievement = Achievement(user_id=current_user.id, achievement_type='perfect_session')
-            db.session.add(achievement)
-            unlocked.append({'type': 'perfect_session', 'name': 'Идеальная сессия', 'icon': '✨'})
-        
-        if hour < 7 and 'early_bird' not in existing:
-            achievement = Achievement(user_id=current_user.id, achievement_type='early_bird')
-            db.session.add(achievement)
-            unlocked.append({'type': 'early_bird', 'name': 'Ранняя пташка', 'icon': '🌅'})
-        
-        if hour >= 23 and 'night_owl' not in existing:
-            achievement = Achievement(user_id=current_user.id, achievement_type='night_owl')
-            db.session.add(achievement)
-            unlocked.append({'type': 'night_owl', 'name': 'Ночная сова', 'icon': '🦉'})
-        
-        if unlocked:
-            db.session.commit()
+        unlocked = record_focus_session(
+            current_user.id, tree, session.distractions, datetime.utcnow().hour
+        )
+    
+    db.session.commit()
+    stats_cache.invalidate(current_user.id, 'focus')
+    offer_focus_totals(totals)
     
     return jsonify({
         'success': True,
@@ -2244,60 +2822,87 @@ def report_distraction(session_id):
         tree.health = max(0, tree.health - 2)
     
     db.session.commit()
+    stats_cache.invalidate(current_user.id, 'focus')
     return jsonify({'success': True, 'distractions': session.distractions})
 
+@app.route('/api/focus/session/<int:session_id>/events', methods=['POST'])
+@login_required
+def ingest_focus_events(session_id):
+    """Пачка событий таймера (отвлечения, пауза, продолжение, heartbeat) одной транзакцией"""
+    session = FocusSession.query.filter_by(id=session_id, user_id=current_user.id).first_or_404()
+    data = request.get_json(silent=True)
+    raw_events = data.get('events') if isinstance(data, dict) else None
+    if not isinstance(raw_events, list):
+        return jsonify({'error': 'Ожидается список events'}), 400
+    if session.ended_at:
+        return jsonify({'error': 'Сессия уже завершена'}), 409
+    
+    events = parse_events(raw_events, session.last_event_seq or 0)
+    distractions, tracked = apply_events(session, events)
+    
+    # Каждое отвлечение немного вредит дереву - одним изменением на пачку
+    tree = None
+    if distractions:
+        tree = FocusTree.query.filter_by(user_id=current_user.id).first()
+        if tree:
+            tree.health = max(0, tree.health - 2 * distractions)
+    
+    db.session.commit()
+    # Записанное время сразу видно в почасовой статистике и тепловой карте
+    if tree or tracked:
+        stats_cache.invalidate(current_user.id, 'focus')
+    
+    return jsonify({
+        'success': True,
+        'applied': len(events),
+        'last_seq': session.last_event_seq,
+        'distractions': session.distractions,
+        'paused': session.paused_at is not None
+    })
+
 @app.route('/api/focus/stats', methods=['GET'])
 @login_required
+@cached_stats('focus')
 def get_focus_stats():
     """Получить статистику фокусировки"""
     from sqlalchemy import func
+    from datetime import timedelta
     
-    # Статистика за сегодня
+    # Неделя по дням из почасовых агрегатов (в том числе сегодня)
     today = datetime.utcnow().date()
-    today_sessions = FocusSession.query.filter(
-        FocusSession.user_id == current_user.id,
-        func.date(FocusSession.started_at) == today,
-        FocusSession.is_completed == True
-    ).all()
-    
-    today_minutes = sum(s.duration_minutes for s in today_sessions)
-    today_count = len(today_sessions)
-    
-    # Статистика за неделю
-    from datetime import timedelta
     week_ago = today - timedelta(days=7)
-    week_sessions = FocusSession.query.filter(
-        FocusSession.user_id == current_user.id,
-        func.date(FocusSession.started_at) >= week_ago,
-        FocusSession.is_completed == True
-    ).all()
+    rows = db.session.query(
+        FocusRollup.day,
+        func.sum(FocusRollup.minutes),
+        func.sum(FocusRollup.sessions)
+    ).filter(
+        FocusRollup.user_id == current_user.id,
+        FocusRollup.day >= week_ago
+    ).group_by(FocusRollup.day).all()
     
-    # Группируем по дням
-    daily_stats = {}
-    for s in week_sessions:
-        day = s.started_at.date().isoformat()
-        if day not in daily_stats:
-            daily_stats[day] = {'minutes': 0, 'sessions': 0}
-        daily_stats[day]['minutes'] += s.duration_minutes
-        daily_stats[day]['sessions'] += 1
+    daily_stats = {
+        day.isoformat(): {'minutes': minutes, 'sessions': sessions}
+        for day, minutes, sessions in rows
+    }
+    today_stats = daily_stats.get(today.isoformat(), {'minutes': 0, 'sessions': 0})
     
     # Дерево
     tree = FocusTree.query.filter_by(user_id=current_user.id).first()
     
     return jsonify({
         'today': {
-            'minutes': today_minutes,
-            'sessions': today_count
+            'minutes': today_stats['minutes'],
+            'sessions': today_stats['sessions']
         },
         'week': {
-            'total_minutes': sum(s.duration_minutes for s in week_sessions),
-            'total_sessions': len(week_sessions),
+            'total_minutes': sum(d['minutes'] for d in daily_stats.values()),
+            'total_sessions': sum(d['sessions'] for d in daily_stats.values()),
             'daily': daily_stats
         },
         'all_time': {
             'total_minutes': tree.total_focus_minutes if tree else 0,
             'total_sessions': tree.total_sessions if tree else 0,
-            'streak_days': tree.streak_days if tree else 0
+            'streak_days': tree.decayed(today)[1] if tree else 0
         }
     })
 
@@ -2305,11 +2910,11 @@ def get_focus_stats():
 
 @app.route('/api/focus/stats/extended', methods=['GET'])
 @login_required
+@cached_stats('focus', 'tasks')
 def get_extended_focus_stats():
     """Расширенная статистика: месяц, год, по часам"""
     from sqlalchemy import func
     from datetime import timedelta
-    import json
     
     today = datetime.utcnow().date()
     period = request.args.get('period', 'month')  # month, year
@@ -2319,39 +2924,56 @@ def get_extended_focus_stats():
     else:
         start_date = today - timedelta(days=30)
     
-    sessions = FocusSession.query.filter(
-        FocusSession.user_id == current_user.id,
-        func.date(FocusSession.started_at) >= start_date,
-        FocusSession.is_completed == True
+    # Почасовые агрегаты за период: не больше 24 строк на день вместо всех сессий
+    rollups = FocusRollup.query.filter(
+        FocusRollup.user_id == current_user.id,
+        FocusRollup.day >= start_date
     ).all()
     
     # Группируем по дням
     daily_stats = {}
-    hourly_stats = {i: 0 for i in range(24)}  # Статистика по часам
-    task_stats = {}  # Статистика по задачам
-    
-    for s in sessions:
-        day = s.started_at.date().isoformat()
-        hour = s.started_at.hour
-        
+    for r in rollups:
+        day = r.day.isoformat()
         if day not in daily_stats:
             daily_stats[day] = {'minutes': 0, 'sessions': 0}
-        daily_stats[day]['minutes'] += s.duration_minutes
-        daily_stats[day]['sessions'] += 1
-        
-        hourly_stats[hour] += s.duration_minutes
-        
-        # Статистика по задачам
-        if s.task_id:
-            if s.task_id not in task_stats:
-                task = Task.query.get(s.task_id)
-                task_stats[s.task_id] = {
-                    'title': task.title if task else 'Удалённая задача',
-                    'minutes': 0,
-                    'sessions': 0
-                }
-            task_stats[s.task_id]['minutes'] += s.duration_minutes
-            task_stats[s.task_id]['sessions'] += 1
+        daily_stats[day]['minutes'] += r.minutes
+        daily_stats[day]['sessions'] += r.sessions
+    
+    # Статистика по часам - из почасового лога, где сессия разнесена по часам, которые она заняла
+    # Как daily и summary - только завершённые сессии (в лог попадает и время брошенных)
+    hourly_stats = {i: 0 for i in range(24)}
+    for hour, seconds in db.session.query(TaskTimeLog.hour, func.sum(TaskTimeLog.seconds)).join(
+        FocusSession, FocusSession.id == TaskTimeLog.session_id
+    ).filter(
+        TaskTimeLog.user_id == current_user.id,
+        TaskTimeLog.date >= start_date,
+        FocusSession.is_completed == True
+    ).group_by(TaskTimeLog.hour):
+        hourly_stats[hour] = seconds // 60
+    
+    # Статистика по задачам: одна группировка в SQL (удалённые задачи - без названия)
+    task_limit = request.args.get('limit', type=int)
+    minutes_sum = func.sum(FocusSession.duration_minutes)
+    task_query = db.session.query(
+        FocusSession.task_id,
+        Task.title,
+        minutes_sum,
+        func.count(FocusSession.id)
+    ).outerjoin(Task, Task.id == FocusSession.task_id).filter(
+        FocusSession.user_id == current_user.id,
+        FocusSession.started_at >= datetime.combine(start_date, datetime.min.time()),
+        FocusSession.is_completed == True,
+        FocusSession.task_id.isnot(None)
+    ).group_by(FocusSession.task_id, Task.title).order_by(minutes_sum.desc(), FocusSession.task_id)
+    if task_limit and task_limit > 0:
+        task_query = task_query.limit(task_limit)
+    
+    task_stats = [{
+        'task_id': task_id,
+        'title': title if title is not None else 'Удалённая задача',
+        'minutes': minutes or 0,
+        'sessions': sessions
+    } for task_id, title, minutes, sessions in task_query.all()]
     
     # Лучший день
     best_day = max(daily_stats.items(), key=lambda x: x[1]['minutes']) if daily_stats else (None, {'minutes': 0})
@@ -2363,10 +2985,10 @@ def get_extended_focus_stats():
         'period': period,
         'daily': daily_stats,
         'hourly': hourly_stats,
-        'tasks': list(task_stats.values()),
+        'tasks': task_stats,
         'summary': {
-            'total_minutes': sum(s.duration_minutes for s in sessions),
-            'total_sessions': len(sessions),
+            'total_minutes': sum(d['minutes'] for d in daily_stats.values()),
+            'total_sessions': sum(d['sessions'] for d in daily_stats.values()),
             'avg_daily_minutes': sum(d['minutes'] for d in daily_stats.values()) // max(len(daily_stats), 1),
             'best_day': {'date': best_day[0], 'minutes': best_day[1]['minutes']},
             'best_hour': {'hour': best_hour[0], 'minutes': best_hour[1]}
@@ -2374,6 +2996,202 @@ def get_extended_focus_stats():
     })
 
 
+@app.route('/api/focus/heatmap', methods=['GET'])
+@login_required
+@cached_stats('focus')
+def get_focus_heatmap():
+    """Тепловая карта фокуса: минуты по дням недели (0 - понедельник) и часам (UTC).
+    Учитывается всё записанное время фокуса, в том числе незавершённых сессий."""
+    from sqlalchemy import func
+    from datetime import timedelta
+    
+    days = min(max(request.args.get('days', 365, type=int), 1), 366)
+    start_date = datetime.utcnow().date() - timedelta(days=days - 1)
+    
+    # Одна группировка по покрывающему индексу (user_id, date, hour, seconds)
+    weekday = (func.cast(func.strftime('%w', TaskTimeLog.date), db.Integer) + 6) % 7
+    rows = db.session.query(weekday, TaskTimeLog.hour, func.sum(TaskTimeLog.seconds)).filter(
+        TaskTimeLog.user_id == current_user.id,
+        TaskTimeLog.date >= start_date
+    ).group_by(weekday, TaskTimeLog.hour).all()
+    
+    matrix = [[0] * 24 for _ in range(7)]
+    for day_of_week, hour, seconds in rows:
+        matrix[day_of_week][hour] = seconds // 60
+    
+    return jsonify({
+        'days': days,
+        'since': start_date.isoformat(),
+        'matrix': matrix,
+        'max_minutes': max(max(row) for row in matrix),
+        'total_minutes': sum(seconds for _, _, seconds in rows) // 60
+    })
+
+
+@app.cli.command('backfill-time-logs')
+def backfill_time_logs():
+    """Заполнить почасовой лог для завершённых сессий, у которых его ещё нет (до появления лога)"""
+    # tracked_until заполняется при завершении, пустой он только у сессий до появления лога
+    sessions = FocusSession.query.filter(
+        FocusSession.ended_at.isnot(None),
+        FocusSession.started_at.isnot(None),
+        FocusSession.tracked_until.is_(None)
+    ).all()
+    for fs in sessions:
+        finish_tracking(fs)
+    db.session.commit()
+    print(f"✓ Сессий добавлено в лог времени: {len(sessions)}")
+
+
+@app.cli.command('rebuild-focus-rollups')
+@click.option('--user-id', type=int, default=None, help='Пересобрать только для одного пользователя')
+def rebuild_focus_rollups(user_id):
+    """Пересобрать почасовые агрегаты фокуса из focus_sessions"""
+    rows = FocusRollup.rebuild(user_id)
+    db.session.commit()
+    print(f"✓ Агрегатов фокуса: {rows}")
+
+
+@app.cli.command('decay-focus-trees')
+@click.option('--date', 'day', type=click.DateTime(formats=['%Y-%m-%d']), default=None,
+              help='Дата, на которую применить увядание (по умолчанию сегодня, UTC)')
+def decay_focus_trees(day):
+    """Ежедневное увядание деревьев без сессий (повторный запуск за ту же дату ничего не меняет)"""
+    today = day.date() if day else datetime.utcnow().date()
+    rows = FocusTree.decay_all(today)
+    db.session.commit()
+    print(f"✓ Деревьев с увяданием на {today.isoformat()}: {rows}")
+
+
+@app.cli.command('rebalance-ranks')
+def rebalance_ranks():
+    """Переписать ранги подзадач и треков там, где после перемещений кончается место"""
+    for model, parent_column in ((Subtask, Subtask.task_id), (Track, Track.playlist_id)):
+        groups = crowded_groups(model, parent_column)
+        for parent_id in groups:
+            rebalance(model, parent_column, parent_id)
+        db.session.commit()
+        print(f"✓ {model.__tablename__}: перебалансировано групп {len(groups)}")
+
+
+def add_completed_session(user_id, session):
+    """Учесть завершённую сессию в агрегатах статистики и рейтингах (без коммита).
+    Рейтинг считает фактические минуты, как дерево. Возвращает новые итоги по периодам рейтинга."""
+    started_at = session.started_at or session.ended_at
+    FocusRollup.add_session(user_id, started_at, session.duration_minutes)
+    return FocusLeaderboard.add_session(user_id, started_at, session.actual_minutes())
+
+
+# ==================== API: РЕЙТИНГИ ФОКУСА ====================
+
+FOCUS_LEADERBOARD_PERIODS = ('week', 'month', 'all')
+
+
+def focus_leaderboard(period_key):
+    """Топ периода в памяти процесса: больше минут - выше"""
+    # Топы прошедших недель и месяцев больше не читаются - не держим их в памяти
+    today = datetime.utcnow().date()
+    leaderboards.retain('focus:', {
+        f'focus:{FocusLeaderboard.key_for(period, today)}' for period in FOCUS_LEADERBOARD_PERIODS
+    })
+    return leaderboards.board(
+        f'focus:{period_key}', lambda e: (-e['minutes'], e['user_id']),
+        size=app.config['FOCUS_LEADERBOARD_SIZE']
+    )
+
+
+def load_focus_leaderboard(period_key, user_ids=None, limit=None):
+    """Первые места периода из focus_leaderboard; user_ids - ограничить кругом пользователей"""
+    query = db.session.query(
+        FocusLeaderboard.user_id, User.username, User.name, User.avatar_url,
+        FocusLeaderboard.minutes, FocusLeaderboard.sessions
+    ).join(User, User.id == FocusLeaderboard.user_id).filter(
+        FocusLeaderboard.period_key == period_key
+    )
+    if user_ids is not None:
+        query = query.filter(FocusLeaderboard.user_id.in_(user_ids))
+    rows = query.order_by(FocusLeaderboard.minutes.desc()).limit(
+        limit or app.config['FOCUS_LEADERBOARD_SIZE']
+    ).all()
+    return [{
+        'user_id': r.user_id,
+        'username': r.username,
+        'name': r.name,
+        'avatar_url': r.avatar_url,
+        'minutes': r.minutes,
+        'sessions': r.sessions
+    } for r in rows]
+
+
+def offer_focus_totals(totals):
+    """Передать новые итоги текущего пользователя в топы рейтингов (после коммита)"""
+    for period_key, minutes, sessions in totals:
+        focus_leaderboard(period_key).offer({
+            'user_id': current_user.id,
+            'username': current_user.username,
+            'name': current_user.name,
+            'avatar_url': current_user.avatar_url,
+            'minutes': minutes,
+            'sessions': sessions
+        })
+
+
+@app.route('/api/leaderboard/focus', methods=['GET'])
+@login_required
+def get_focus_leaderboard():
+    """Рейтинг по минутам фокуса: period=week|month|all, scope=global|friends"""
+    period = request.args.get('period', 'week')
+    if period not in FOCUS_LEADERBOARD_PERIODS:
+        return jsonify({'error': 'Неизвестный период'}), 400
+    scope = request.args.get('scope', 'global')
+    limit = max(1, min(request.args.get('limit', app.config['FOCUS_LEADERBOARD_SIZE'], type=int),
+                       app.config['FOCUS_LEADERBOARD_SIZE']))
+    period_key = FocusLeaderboard.key_for(period, datetime.utcnow().date())
+    
+    if scope == 'friends':
+        # Друзей немного: читаем их строки по первичному ключу и сортируем здесь
+        friend_ids = [f for (f,) in db.session.query(friendships.c.friend_id).filter(
+            friendships.c.user_id == current_user.id)]
+        user_ids = [current_user.id] + friend_ids
+        leaders = load_focus_leaderboard(period_key, user_ids=user_ids, limit=len(user_ids))
+    else:
+        scope = 'global'
+        leaders = focus_leaderboard(period_key).get(lambda: load_focus_leaderboard(period_key))
+    
+    # Место - 1 + число участников с большим временем (равные делят место)
+    result, rank = [], 0
+    for i, entry in enumerate(leaders):
+        if i == 0 or entry['minutes'] < leaders[i - 1]['minutes']:
+            rank = i + 1
+        result.append(dict(entry, rank=rank, is_me=entry['user_id'] == current_user.id))
+    
+    me = db.session.get(FocusLeaderboard, (period_key, current_user.id))
+    my_rank = next((e['rank'] for e in result if e['is_me']), None)
+    if me and my_rank is None:
+        # Вне топа: считаем по индексу рейтинга
+        my_rank = FocusLeaderboard.rank(period_key, me.minutes)
+    
+    return jsonify({
+        'period': period,
+        'period_key': period_key,
+        'scope': scope,
+        'leaders': result[:limit],
+        'me': {
+            'rank': my_rank,
+            'minutes': me.minutes if me else 0,
+            'sessions': me.sessions if me else 0
+        }
+    })
+
+
+@app.cli.command('rebuild-focus-leaderboard')
+def rebuild_focus_leaderboard():
+    """Пересобрать рейтинги фокуса из focus_sessions (то же делает migrate_db)"""
+    rows = FocusLeaderboard.rebuild()
+    db.session.commit()
+    print(f"✓ Строк рейтинга фокуса: {rows}")
+
+
 # ==================== API: ЖУРНАЛ НАСТРОЕНИЯ ====================
 
 @app.route('/api/mood', methods=['GET'])
@@ -2404,6 +3222,7 @@ def get_mood_entries():
 
 @app.route('/api/mood', methods=['POST'])
 @login_required
+@idempotent
 def create_mood_entry():
     """Создать запись настроения"""
     data = request.json
@@ -2422,6 +3241,7 @@ def create_mood_entry():
         existing.note = data.get('note', existing.note)
         existing.tags = ','.join(data.get('tags', []))
         db.session.commit()
+        stats_cache.invalidate(current_user.id, 'mood')
         return jsonify({'success': True, 'id': existing.id, 'updated': True})
     
     entry = MoodEntry(
@@ -2433,13 +3253,16 @@ def create_mood_entry():
         date=today
     )
     db.session.add(entry)
+    unlocked = change_counter(current_user.id, 'mood_entries', 1)
     db.session.commit()
+    stats_cache.invalidate(current_user.id, 'mood')
     
-    return jsonify({'success': True, 'id': entry.id})
+    return jsonify({'success': True, 'id': entry.id, 'unlocked': unlocked})
 
 
 @app.route('/api/mood/stats', methods=['GET'])
 @login_required
+@cached_stats('mood')
 def get_mood_stats():
     """Статистика настроения"""
     from sqlalchemy import func
@@ -2585,26 +3408,15 @@ def delete_task_template(template_id):
 
 @app.route('/api/tasks/from-template', methods=['POST'])
 @login_required
+@idempotent
 def create_task_from_template():
     """Создать задачу из шаблона"""
     import json
-    from datetime import timedelta
     data = request.json
     template_id = data.get('template_id')
     
     template = TaskTemplate.query.get_or_404(template_id)
-    
-    # Защита от дублирования: проверяем, не создавалась ли задача из этого шаблона в последние 5 секунд
     title = data.get('title', template.name)
-    five_seconds_ago = datetime.utcnow() - timedelta(seconds=5)
-    recent_duplicate = Task.query.filter(
-        Task.user_id == current_user.id,
-        Task.title == title,
-        Task.created_at >= five_seconds_ago
-    ).first()
-    
-    if recent_duplicate:
-        return jsonify({'success': True, 'task_id': recent_duplicate.id, 'duplicate': True})
     
     # Создаём задачу
     task = Task(
@@ -2631,36 +3443,12 @@ def create_task_from_template():
         db.session.add(subtask)
     
     db.session.commit()
+    stats_cache.invalidate(current_user.id, 'tasks')
     return jsonify({'success': True, 'task_id': task.id})
 
 
 # ==================== API: ДОСТИЖЕНИЯ (ГЕЙМИФИКАЦИЯ) ====================
 
-# Определение всех достижений
-ACHIEVEMENTS = {
-    'first_session': {'name': 'Первый шаг', 'icon': '🌱', 'desc': 'Завершите первую сессию фокуса'},
-    'sessions_10': {'name': 'Начинающий', 'icon': '🌿', 'desc': 'Завершите 10 сессий'},
-    'sessions_50': {'name': 'Практик', 'icon': '🌳', 'desc': 'Завершите 50 сессий'},
-    'sessions_100': {'name': 'Мастер фокуса', 'icon': '🏆', 'desc': 'Завершите 100 сессий'},
-    'streak_3': {'name': 'Три дня подряд', 'icon': '🔥', 'desc': '3 дня подряд с сессиями'},
-    'streak_7': {'name': 'Неделя силы', 'icon': '💪', 'desc': '7 дней подряд с сессиями'},
-    'streak_30': {'name': 'Месяц дисциплины', 'icon': '⭐', 'desc': '30 дней подряд'},
-    'hours_10': {'name': '10 часов фокуса', 'icon': '⏰', 'desc': 'Накопите 10 часов фокуса'},
-    'hours_50': {'name': '50 часов фокуса', 'icon': '🎯', 'desc': 'Накопите 50 часов фокуса'},
-    'hours_100': {'name': 'Центурион', 'icon': '👑', 'desc': 'Накопите 100 часов фокуса'},
-    'perfect_session': {'name': 'Идеальная сессия', 'icon': '✨', 'desc': 'Сессия без отвлечений'},
-    'early_bird': {'name': 'Ранняя пташка', 'icon': '🌅', 'desc': 'Сессия до 7 утра'},
-    'night_owl': {'name': 'Ночная сова', 'icon': '🦉', 'desc': 'Сессия после 23:00'},
-    'tree_level_5': {'name': 'Садовник', 'icon': '🌲', 'desc': 'Дерево достигло 5 уровня'},
-    'tree_level_10': {'name': 'Лесник', 'icon': '🌴', 'desc': 'Дерево достигло 10 уровня'},
-    'tasks_10': {'name': 'Продуктивный', 'icon': '📋', 'desc': 'Завершите 10 задач'},
-    'tasks_50': {'name': 'Машина', 'icon': '🚀', 'desc': 'Завершите 50 задач'},
-    'gratitude_7': {'name': 'Благодарный', 'icon': '🙏', 'desc': '7 записей благодарности'},
-    'mood_streak_7': {'name': 'Самопознание', 'icon': '💭', 'desc': '7 дней записей настроения'},
-    'memory_master': {'name': 'Острый ум', 'icon': '🧠', 'desc': 'Достигните 10 уровня в игре на память'},
-}
-
-
 @app.route('/api/achievements', methods=['GET'])
 @login_required
 def get_achievements():
@@ -2686,69 +3474,13 @@ def get_achievements():
     })
 
 
-def check_and_unlock_achievements(user_id):
-    """Проверить и разблокировать достижения"""
-    unlocked = []
-    existing = {a.achievement_type for a in Achievement.query.filter_by(user_id=user_id).all()}
-    
-    tree = FocusTree.query.filter_by(user_id=user_id).first()
-    if not tree:
-        return unlocked
-    
-    # Проверяем достижения по сессиям
-    checks = [
-        ('first_session', tree.total_sessions >= 1),
-        ('sessions_10', tree.total_sessions >= 10),
-        ('sessions_50', tree.total_sessions >= 50),
-        ('sessions_100', tree.total_sessions >= 100),
-        ('streak_3', tree.streak_days >= 3),
-        ('streak_7', tree.streak_days >= 7),
-        ('streak_30', tree.streak_days >= 30),
-        ('hours_10', tree.total_focus_minutes >= 600),
-        ('hours_50', tree.total_focus_minutes >= 3000),
-        ('hours_100', tree.total_focus_minutes >= 6000),
-        ('tree_level_5', tree.level >= 5),
-        ('tree_level_10', tree.level >= 10),
-    ]
-    
-    # Проверяем задачи
-    completed_tasks = Task.query.filter_by(user_id=user_id, status='completed').count()
-    checks.append(('tasks_10', completed_tasks >= 10))
-    checks.append(('tasks_50', completed_tasks >= 50))
-    
-    # Проверяем благодарности
-    gratitude_count = GratitudeEntry.query.filter_by(user_id=user_id).count()
-    checks.append(('gratitude_7', gratitude_count >= 7))
-    
-    # Проверяем настроение
-    mood_count = MoodEntry.query.filter_by(user_id=user_id).count()
-    checks.append(('mood_streak_7', mood_count >= 7))
-    
-    # Проверяем игры на память
-    best_memory = db.session.query(db.func.max(MemoryGameScore.level)).filter_by(user_id=user_id).scalar() or 0
-    checks.append(('memory_master', best_memory >= 10))
-    
-    for achievement_type, condition in checks:
-        if condition and achievement_type not in existing:
-            achievement = Achievement(user_id=user_id, achievement_type=achievement_type)
-            db.session.add(achievement)
-            unlocked.append({
-                'type': achievement_type,
-                'name': ACHIEVEMENTS[achievement_type]['name'],
-                'icon': ACHIEVEMENTS[achievement_type]['icon']
-            })
-    
-    if unlocked:
-        db.session.commit()
-    
-    return unlocked
-
-
 @app.route('/api/achievements/check', methods=['POST'])
 @login_required
 def check_achievements():
-    """Проверить новые достижения"""
-    unlocked = check_and_unlock_achievements(current_user.id)
+    """Проверить новые достижения по всем счётчикам и дереву (ручной пересмотр)"""
+    tree = FocusTree.query.filter_by(user_id=current_user.id).first()
+    unlocked = check_all_achievements(current_user.id, tree)
+    db.session.commit()
     return jsonify({'unlocked': unlocked})
 
 
@@ -2778,6 +3510,7 @@ def get_gratitude_entries():
 
 @app.route('/api/gratitude', methods=['POST'])
 @login_required
+@idempotent
 def create_gratitude_entry():
     """Создать запись благодарности"""
     data = request.json
@@ -2790,10 +3523,10 @@ def create_gratitude_entry():
         date=today
     )
     db.session.add(entry)
-    db.session.commit()
     
     # Проверяем достижения
-    unlocked = check_and_unlock_achievements(current_user.id)
+    unlocked = change_counter(current_user.id, 'gratitude_entries', 1)
+    db.session.commit()
     
     return jsonify({'success': True, 'id': entry.id, 'unlocked': unlocked})
 
@@ -2804,34 +3537,30 @@ def delete_gratitude_entry(entry_id):
     """Удалить запись благодарности"""
     entry = GratitudeEntry.query.filter_by(id=entry_id, user_id=current_user.id).first_or_404()
     db.session.delete(entry)
+    change_counter(current_user.id, 'gratitude_entries', -1)
     db.session.commit()
     return jsonify({'success': True})
 
 
 # ==================== API: ИГРЫ НА ПАМЯТЬ ====================
 
+# Рейтинг в памяти создаётся на каждый тип игры - принимаем только известные
+MEMORY_GAME_TYPES = ('sequence', 'cards', 'numbers')
+
+
 @app.route('/api/memory-game/scores', methods=['GET'])
 @login_required
 def get_memory_scores():
     """Получить лучшие результаты игр"""
     game_type = request.args.get('type', 'sequence')
+    if game_type not in MEMORY_GAME_TYPES:
+        return jsonify({'error': 'Неизвестный тип игры'}), 400
     
     # Лучший результат пользователя
-    best = MemoryGameScore.query.filter_by(
-        user_id=current_user.id,
-        game_type=game_type
-    ).order_by(MemoryGameScore.level.desc()).first()
-    
-    # Топ-10 всех пользователей
-    top_scores = db.session.query(
-        MemoryGameScore.user_id,
-        User.username,
-        db.func.max(MemoryGameScore.level).label('best_level')
-    ).join(User).filter(
-        MemoryGameScore.game_type == game_type
-    ).group_by(MemoryGameScore.user_id, User.username).order_by(
-        db.desc('best_level')
-    ).limit(10).all()
+    best = db.session.get(MemoryGameBest, (game_type, current_user.id))
+    
+    # Топ-10 всех пользователей (из памяти, БД - только при загрузке)
+    top_scores = memory_leaderboard(game_type).get(lambda: load_memory_leaderboard(game_type))
     
     return jsonify({
         'personal_best': {
@@ -2839,18 +3568,38 @@ def get_memory_scores():
             'score': best.score if best else 0
         },
         'leaderboard': [{
-            'username': s.username,
-            'level': s.best_level,
-            'is_me': s.user_id == current_user.id
+            'username': s['username'],
+            'level': s['level'],
+            'is_me': s['user_id'] == current_user.id
         } for s in top_scores]
     })
 
 
+@app.route('/api/memory-game/rank', methods=['GET'])
+@login_required
+def get_memory_rank():
+    """Место пользователя в общем рейтинге игры"""
+    game_type = request.args.get('type', 'sequence')
+    if game_type not in MEMORY_GAME_TYPES:
+        return jsonify({'error': 'Неизвестный тип игры'}), 400
+    best = db.session.get(MemoryGameBest, (game_type, current_user.id))
+    if not best:
+        return jsonify({'rank': None, 'level': 0, 'score': 0})
+    
+    return jsonify({
+        'rank': MemoryGameBest.rank(game_type, best.level, best.score),
+        'level': best.level,
+        'score': best.score
+    })
+
+
 @app.route('/api/memory-game/scores', methods=['POST'])
 @login_required
 def save_memory_score():
     """Сохранить результат игры"""
     data = request.json
+    if data.get('game_type') not in MEMORY_GAME_TYPES:
+        return jsonify({'error': 'Неизвестный тип игры'}), 400
     
     score = MemoryGameScore(
         user_id=current_user.id,
@@ -2859,18 +3608,53 @@ def save_memory_score():
         level=data['level']
     )
     db.session.add(score)
-    db.session.commit()
+    is_best = MemoryGameBest.record(current_user.id, score.game_type, score.level, score.score)
     
     # Проверяем достижения
-    unlocked = check_and_unlock_achievements(current_user.id)
+    unlocked = record_memory_level(current_user.id, score.level)
+    db.session.commit()
     
-    return jsonify({'success': True, 'unlocked': unlocked})
+    if is_best:
+        memory_leaderboard(score.game_type).offer({
+            'user_id': current_user.id,
+            'username': current_user.username,
+            'level': score.level,
+            'score': score.score
+        })
+    
+    return jsonify({'success': True, 'unlocked': unlocked, 'is_best': is_best})
+
+
+def memory_leaderboard(game_type):
+    """Топ игры на память в памяти процесса: уровень, затем очки"""
+    return leaderboards.board(f'memory:{game_type}', lambda e: (-e['level'], -e['score'], e['user_id']))
+
+
+def load_memory_leaderboard(game_type):
+    """Первые места игры из memory_game_best (по индексу рейтинга)"""
+    rows = db.session.query(
+        MemoryGameBest.user_id, User.username, MemoryGameBest.level, MemoryGameBest.score
+    ).join(User, User.id == MemoryGameBest.user_id).filter(
+        MemoryGameBest.game_type == game_type
+    ).order_by(
+        MemoryGameBest.level.desc(), MemoryGameBest.score.desc()
+    ).limit(leaderboards.size).all()
+    return [{'user_id': r.user_id, 'username': r.username, 'level': r.level, 'score': r.score} for r in rows]
+
+
+@app.cli.command('rebuild-memory-best')
+def rebuild_memory_best():
+    """Пересобрать лучшие результаты игр на память из memory_game_scores"""
+    rows = MemoryGameBest.rebuild()
+    db.session.commit()
+    print(f"✓ Лучших результатов: {rows}")
 
 
 # ==================== API: ПРОГРЕСС ЗАДАЧ ====================
 
 @app.route('/api/tasks/progress', methods=['GET'])
 @login_required
+@cached_stats('tasks')
 def get_tasks_progress():
     """Получить прогресс выполнения задач"""
     from sqlalchemy import func
@@ -2938,5 +3722,20 @@ def get_tasks_progress():
     })
 
 
+# ==================== API: СЛУЖЕБНОЕ ====================
+
+@app.route('/api/stats/cache', methods=['GET'])
+@login_required
+def get_cache_stats():
+    """Счётчики попаданий/промахов кэшей процесса (в режиме отладки или для администраторов)"""
+    if not (app.debug or (current_user.email or '').lower() in app.config['ADMIN_EMAILS']):
+        return jsonify({'error': 'Доступ запрещён'}), 403
+    return jsonify({
+        'chat_access': chat_access_cache.stats(),
+        'stats': stats_cache.stats(),
+        'idempotency': idempotency_store.stats()
+    })
+
+
 if __name__ == '__main__':
     app.run(debug=True, port=5000)
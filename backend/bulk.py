@@ -0,0 +1,95 @@
+"""
+Модуль пакетных изменений
+
+Клиент присылает список операций [{'op': 'update', 'id': 1, 'status': ...},
+{'op': 'delete', 'id': 2}], и они сводятся к set-based запросам: один
+UPDATE ... SET поле = CASE id WHEN ... END на все изменения и один
+DELETE ... WHERE id IN (...). Принадлежность записей пользователю
+вызывающий код проверяет заранее одним IN-запросом.
+"""
+from models import db
+
+OPERATIONS = ('update', 'delete')
+
+
+# Строгие приведения типов для полей: значение JSON не того типа - ошибка, а не str(None) или int(1.9)
+def integer(value):
+    if isinstance(value, bool) or not isinstance(value, int):
+        raise ValueError(value)
+    return value
+
+
+def number(value):
+    if isinstance(value, bool) or not isinstance(value, (int, float)):
+        raise ValueError(value)
+    return value
+
+
+def boolean(value):
+    if not isinstance(value, bool):
+        raise ValueError(value)
+    return value
+
+
+def text(value):
+    if not isinstance(value, str):
+        raise ValueError(value)
+    return value
+
+
+def title(value):
+    """Непустая строка"""
+    if not isinstance(value, str) or not value.strip():
+        raise ValueError(value)
+    return value
+
+
+def parse_operations(raw_operations, fields, max_operations):
+    """
+    Разобрать операции клиента: (updates {id: {поле: значение}}, deletes {id}).
+    fields - разрешённые поля и функции приведения типа. Ошибки - ValueError
+    с текстом для ответа 400. Удаление записи отменяет её изменения.
+    """
+    if not isinstance(raw_operations, list) or not raw_operations:
+        raise ValueError('operations должен быть непустым списком')
+    if len(raw_operations) > max_operations:
+        raise ValueError(f'Не больше {max_operations} операций за запрос')
+
+    updates, deletes = {}, set()
+    for raw in raw_operations:
+        if not isinstance(raw, dict) or raw.get('op') not in OPERATIONS:
+            raise ValueError('op должен быть update или delete')
+        try:
+            record_id = integer(raw.get('id'))
+        except ValueError:
+            raise ValueError('У каждой операции должен быть числовой id')
+
+        if raw['op'] == 'delete':
+            deletes.add(record_id)
+            continue
+        values = {}
+        for field, convert in fields.items():
+            if field in raw:
+                try:
+                    values[field] = convert(raw[field])
+                except (TypeError, ValueError):
+                    raise ValueError(f'Некорректное значение поля {field}')
+        if not values:
+            raise ValueError(f'Нет полей для изменения записи {record_id}')
+        updates.setdefault(record_id, {}).update(values)
+
+    for record_id in deletes:
+        updates.pop(record_id, None)
+    return updates, deletes
+
+
+def case_values(model, updates):
+    """Значения SET для одного UPDATE: по выражению CASE id на каждое изменяемое поле"""
+    by_field = {}
+    for record_id, values in updates.items():
+        for field, value in values.items():
+            by_field.setdefault(field, {})[record_id] = value
+    return {
+        field: db.case(values, value=model.id, else_=getattr(model, field))
+        for field, values in by_field.items()
+    }
@@ -0,0 +1,267 @@
+"""
+Модуль кэшей
+
+LRUCache - ограниченный по размеру словарь с вытеснением давно не использованных
+ключей и необязательным TTL. Кэш локален для воркера: при нескольких процессах
+изменения в одном не видны другим, поэтому для данных о правах TTL держим коротким.
+
+SQLiteCache - тот же интерфейс поверх отдельного файла SQLite, общий для всех
+воркеров на одной машине (значения хранятся в JSON).
+
+StatsCache - кэш статистик пользователя поверх любого из бэкендов. Инвалидация
+по областям (focus, tasks, mood): запись меняет поколение области, и старые
+ключи просто перестают читаться, пока не истечёт их TTL.
+
+IdempotencyStore - ответы на запросы с заголовком Idempotency-Key. Первый
+запрос занимает ключ (add), повтор получает сохранённый ответ без обращения
+к основной БД.
+"""
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+MISSING = object()
+
+
+class LRUCache:
+    """Потокобезопасный LRU-кэш со счётчиками попаданий и промахов"""
+
+    def __init__(self, maxsize=1024, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._data = OrderedDict()  # key -> (expires_at, value)
+        self._lock = threading.Lock()
+
+    def get(self, key, default=MISSING):
+        """Значение по ключу или default, если его нет или оно устарело"""
+        with self._lock:
+            item = self._data.get(key)
+            if item is not None and (item[0] is None or item[0] > time.monotonic()):
+                self._data.move_to_end(key)
+                self.hits += 1
+                return item[1]
+            if item is not None:
+                del self._data[key]
+            self.misses += 1
+            return default
+
+    def set(self, key, value):
+        """Сохранить значение, вытеснив самый старый ключ при переполнении"""
+        with self._lock:
+            self._store(key, value)
+
+    def _store(self, key, value):
+        """Запись под уже взятой блокировкой"""
+        expires_at = time.monotonic() + self.ttl if self.ttl else None
+        self._data[key] = (expires_at, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+            self.evictions += 1
+
+    def add(self, key, value):
+        """Сохранить значение, только если ключа нет (или он устарел); True - сохранено"""
+        with self._lock:
+            item = self._data.get(key)
+            if item is not None and (item[0] is None or item[0] > time.monotonic()):
+                return False
+            self._store(key, value)
+            return True
+
+    def delete(self, key):
+        """Удалить ключ, если он есть"""
+        with self._lock:
+            self._data.pop(key, None)
+
+    def delete_where(self, predicate):
+        """Удалить все ключи, для которых predicate(key) истинно"""
+        with self._lock:
+            for key in [k for k in self._data if predicate(k)]:
+                del self._data[key]
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def stats(self):
+        """Счётчики для мониторинга"""
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                'size': len(self._data),
+                'maxsize': self.maxsize,
+                'ttl': self.ttl,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'hit_rate': round(self.hits / total, 3) if total else 0.0
+            }
+
+
+class SQLiteCache:
+    """Кэш в файле SQLite, общий для процессов; интерфейс как у LRUCache"""
+
+    PURGE_EVERY = 500  # Чистить просроченные ключи раз в N записей
+
+    def __init__(self, path, ttl=None):
+        self.path = path
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._writes = 0
+        self._local = threading.local()
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._conn().execute(
+            'CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, value TEXT NOT NULL, expires_at REAL)'
+        )
+
+    def _conn(self):
+        """Соединение на поток, в режиме автокоммита и WAL"""
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+        return conn
+
+    def get(self, key, default=MISSING):
+        row = self._conn().execute('SELECT value, expires_at FROM cache WHERE key = ?', (key,)).fetchone()
+        if row is not None and (row[1] is None or row[1] > time.time()):
+            self.hits += 1
+            return json.loads(row[0])
+        self.misses += 1
+        return default
+
+    def set(self, key, value):
+        expires_at = time.time() + self.ttl if self.ttl else None
+        conn = self._conn()
+        conn.execute(
+            'INSERT OR REPLACE INTO cache (key, value, expires_at) VALUES (?, ?, ?)',
+            (key, json.dumps(value, ensure_ascii=False), expires_at)
+        )
+        self._writes += 1
+        if self._writes % self.PURGE_EVERY == 0:
+            conn.execute('DELETE FROM cache WHERE expires_at IS NOT NULL AND expires_at <= ?', (time.time(),))
+
+    def add(self, key, value):
+        now = time.time()
+        cursor = self._conn().execute(
+            'INSERT INTO cache (key, value, expires_at) VALUES (?, ?, ?) '
+            'ON CONFLICT(key) DO UPDATE SET value = excluded.value, expires_at = excluded.expires_at '
+            'WHERE cache.expires_at IS NOT NULL AND cache.expires_at <= ?',
+            (key, json.dumps(value, ensure_ascii=False), now + self.ttl if self.ttl else None, now)
+        )
+        return cursor.rowcount > 0
+
+    def delete(self, key):
+        self._conn().execute('DELETE FROM cache WHERE key = ?', (key,))
+
+    def clear(self):
+        self._conn().execute('DELETE FROM cache')
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            'size': self._conn().execute('SELECT COUNT(*) FROM cache').fetchone()[0],
+            'path': self.path,
+            'ttl': self.ttl,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': round(self.hits / total, 3) if total else 0.0
+        }
+
+
+def create_cache_backend(kind, maxsize=1024, ttl=None, path=None):
+    """Бэкенд кэша по настройке: 'memory' (по умолчанию) или 'sqlite'"""
+    if kind == 'sqlite':
+        return SQLiteCache(path, ttl=ttl)
+    return LRUCache(maxsize=maxsize, ttl=ttl)
+
+
+class StatsCache:
+    """Готовые ответы статистики по пользователю с инвалидацией по областям"""
+
+    def __init__(self, backend):
+        self.backend = backend
+
+    def _generation(self, user_id, scope):
+        return self.backend.get(f'gen:{user_id}:{scope}', 0)
+
+    def get_or_compute(self, user_id, scopes, name, compute, should_cache=None):
+        """
+        Вернуть значение из кэша или посчитать compute() и сохранить.
+        Ключ включает поколения всех областей, от которых зависит значение.
+        """
+        generations = ':'.join(str(self._generation(user_id, scope)) for scope in scopes)
+        key = f'stats:{user_id}:{name}:{generations}'
+        value = self.backend.get(key)
+        if value is MISSING:
+            value = compute()
+            if should_cache is None or should_cache(value):
+                self.backend.set(key, value)
+        return value
+
+    def invalidate(self, user_id, *scopes):
+        """Сбросить кэш областей пользователя (новое поколение)"""
+        for scope in scopes:
+            self.backend.set(f'gen:{user_id}:{scope}', uuid.uuid4().hex[:12])
+
+    def stats(self):
+        return self.backend.stats()
+
+
+class IdempotencyStore:
+    """Сохранённые ответы по ключу Idempotency-Key"""
+
+    POLL_INTERVAL = 0.05
+
+    def __init__(self, backend, wait=5.0):
+        self.backend = backend
+        self.wait = wait  # Сколько ждать ответа исходного запроса, если он ещё выполняется
+
+    @staticmethod
+    def fingerprint(*parts):
+        """Отпечаток запроса: тот же ключ с другим телом - ошибка клиента"""
+        digest = hashlib.sha256()
+        for part in parts:
+            digest.update(part if isinstance(part, bytes) else str(part).encode())
+            digest.update(b'\0')
+        return digest.hexdigest()[:32]
+
+    def begin(self, key, fingerprint):
+        """
+        Занять ключ перед выполнением запроса. None - ключ новый, запрос нужно
+        выполнить и вызвать finish()/release(). Иначе - сохранённая запись
+        {'fingerprint', 'status', 'body', 'mimetype'}; status None значит, что
+        исходный запрос так и не завершился за время ожидания.
+        """
+        deadline = time.monotonic() + self.wait
+        while True:
+            if self.backend.add(key, {'fingerprint': fingerprint, 'status': None}):
+                return None
+            record = self.backend.get(key)
+            if record is MISSING:
+                continue  # Исходный запрос упал и освободил ключ
+            if record['status'] is not None or record['fingerprint'] != fingerprint or time.monotonic() >= deadline:
+                return record
+            time.sleep(self.POLL_INTERVAL)
+
+    def finish(self, key, fingerprint, status, body, mimetype):
+        """Сохранить ответ для повторов"""
+        self.backend.set(key, {'fingerprint': fingerprint, 'status': status, 'body': body, 'mimetype': mimetype})
+
+    def release(self, key):
+        """Освободить ключ без ответа (ошибка сервера) - повтор выполнится заново"""
+        self.backend.delete(key)
+
+    def stats(self):
+        return self.backend.stats()
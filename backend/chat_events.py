@@ -0,0 +1,68 @@
+"""
+Модуль рассылки событий чатов (Server-Sent Events)
+
+Брокер живёт в памяти процесса: каждый открытый поток /api/chats/<id>/events
+получает собственную очередь, а обработчики send/edit/delete публикуют в неё
+события после коммита. При нескольких воркерах брокер доставляет только
+события своего процесса; новые сообщения из других воркеров поток раз в
+CHAT_EVENTS_POLL секунд дочитывает из БД (Message.id > последнего отданного),
+если Chat.last_message_id показывает, что они есть. Правки и удаления из
+других воркеров клиент получает при переподключении.
+
+Поток занимает воркер, пока чат открыт, поэтому включается флагом
+CHAT_EVENTS_ENABLED только при асинхронных воркерах; без него клиент
+опрашивает /api/chats/<id>/messages?after_id=.
+"""
+import json
+import queue
+import threading
+
+
+class ChatEventBroker:
+    """Подписки на события чатов в рамках одного процесса"""
+
+    def __init__(self, queue_size=100):
+        self.queue_size = queue_size
+        self._subscribers = {}  # chat_id -> set(queue.Queue)
+        self._lock = threading.Lock()
+
+    def subscribe(self, chat_id):
+        """Создать очередь подписчика для чата"""
+        q = queue.Queue(maxsize=self.queue_size)
+        with self._lock:
+            self._subscribers.setdefault(chat_id, set()).add(q)
+        return q
+
+    def unsubscribe(self, chat_id, q):
+        """Удалить очередь подписчика"""
+        with self._lock:
+            subscribers = self._subscribers.get(chat_id)
+            if subscribers:
+                subscribers.discard(q)
+                if not subscribers:
+                    del self._subscribers[chat_id]
+
+    def publish(self, chat_id, event, data):
+        """Отправить событие всем подписчикам чата"""
+        with self._lock:
+            subscribers = list(self._subscribers.get(chat_id, ()))
+
+        for q in subscribers:
+            try:
+                q.put_nowait((event, data))
+            except queue.Full:
+                # Клиент не успевает читать - отключаем, он переподключится и догонит
+                self.unsubscribe(chat_id, q)
+                try:
+                    q.get_nowait()
+                    q.put_nowait((None, None))
+                except (queue.Empty, queue.Full):
+                    pass
+
+
+def format_sse(event, data):
+    """Сформировать кадр text/event-stream"""
+    return f'event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n'
+
+
+broker = ChatEventBroker()
@@ -0,0 +1,162 @@
+"""
+Проверка планов частых запросов
+
+Прогоняет EXPLAIN QUERY PLAN для запросов, которые выполняются на каждом
+открытии чата, списка задач, плейлиста и статистики фокуса, и завершается
+с кодом 1, если какой-то из них читает таблицу целиком (SCAN вместо SEARCH).
+
+Проверяется не рабочая база, а свежая временная: таблицы из моделей, индексы
+из migrate_db и без статистики ANALYZE. На маленькой базе sqlite_stat1 честно
+подсказывает планировщику SCAN, и результат зависел бы от данных.
+
+Запуск: python check_query_plans.py
+"""
+import contextlib
+import io
+import os
+import shutil
+import sqlite3
+import sys
+import tempfile
+from datetime import date, datetime
+
+# База и хранилище ключей идемпотентности - во временной папке, до импорта app (Config читает окружение)
+TMP_DIR = tempfile.mkdtemp(prefix='check_query_plans_')
+DB_PATH = os.path.join(TMP_DIR, 'focus_app.db')
+os.environ['DATABASE_URL'] = f'sqlite:///{DB_PATH}'
+os.environ['IDEMPOTENCY_PATH'] = os.path.join(TMP_DIR, 'idempotency.db')
+
+from sqlalchemy import and_, func
+
+import migrate_db
+from app import app
+from models import db, Chat, ChatMember, Message, FocusSession, FocusRollup, Task, Subtask, Track, MemoryGameBest, FocusLeaderboard, TaskTimeLog, User
+
+
+def build_database():
+    """Индексы миграции поверх таблиц, созданных при импорте app; статистику ANALYZE убираем"""
+    migrate_db.db_path = DB_PATH
+    with contextlib.redirect_stdout(io.StringIO()):
+        migrate_db.migrate()
+    conn = sqlite3.connect(DB_PATH)
+    conn.execute('DROP TABLE IF EXISTS sqlite_stat1')
+    conn.commit()
+    conn.close()
+
+
+def hot_queries():
+    """Частые запросы приложения в том виде, в каком их строит app.py"""
+    chat_id, user_id, task_id, playlist_id = 1, 1, 1, 1
+    return [
+        ('Сообщения чата (последние)', Message.query
+            .filter(Message.chat_id == chat_id)
+            .order_by(Message.id.desc()).limit(51)),
+        ('Сообщения чата (страница)', Message.query
+            .filter_by(chat_id=chat_id)
+            .order_by(Message.created_at.desc()).limit(50).offset(50)),
+        ('Пересчёт непрочитанных', db.session.query(func.count(Message.id))
+            .filter(Message.chat_id == chat_id, Message.sender_id != user_id, Message.id > 0)),
+        ('Участник чата', ChatMember.query.filter_by(chat_id=chat_id, user_id=user_id)),
+        ('Список чатов', db.session.query(Chat, ChatMember.unread_count, Message)
+            .join(ChatMember, and_(ChatMember.chat_id == Chat.id, ChatMember.user_id == user_id))
+            .outerjoin(Message, Message.id == Chat.last_message_id)
+            .order_by(Chat.last_activity_at.desc())),
+        ('Фокус за неделю по дням', db.session.query(
+                FocusRollup.day, func.sum(FocusRollup.minutes), func.sum(FocusRollup.sessions))
+            .filter(FocusRollup.user_id == user_id, FocusRollup.day >= date(2026, 1, 1))
+            .group_by(FocusRollup.day)),
+        ('Агрегаты фокуса за период', FocusRollup.query
+            .filter(FocusRollup.user_id == user_id, FocusRollup.day >= date(2026, 1, 1))),
+        ('Фокус по часам (завершённые сессии)', db.session.query(TaskTimeLog.hour, func.sum(TaskTimeLog.seconds))
+            .join(FocusSession, FocusSession.id == TaskTimeLog.session_id)
+            .filter(TaskTimeLog.user_id == user_id, TaskTimeLog.date >= date(2026, 1, 1),
+                    FocusSession.is_completed == True)
+            .group_by(TaskTimeLog.hour)),
+        ('Фокус по задачам', db.session.query(
+                FocusSession.task_id, Task.title, func.sum(FocusSession.duration_minutes), func.count(FocusSession.id))
+            .outerjoin(Task, Task.id == FocusSession.task_id)
+            .filter(FocusSession.user_id == user_id,
+                    FocusSession.started_at >= datetime(2026, 1, 1),
+                    FocusSession.is_completed == True,
+                    FocusSession.task_id.isnot(None))
+            .group_by(FocusSession.task_id, Task.title)),
+        ('Список задач', Task.query
+            .filter_by(user_id=user_id).order_by(Task.created_at.desc())),
+        ('Список задач (страница)', Task.query
+            .filter(Task.user_id == user_id,
+                    db.tuple_(Task.created_at, Task.id) < (date(2026, 1, 1), 100))
+            .order_by(Task.created_at.desc(), Task.id.desc()).limit(101)),
+        ('Изменённые задачи', Task.query
+            .filter(Task.user_id == user_id, Task.updated_at > date(2026, 1, 1))),
+        ('Подзадачи страницы задач', Subtask.query
+            .filter(Subtask.task_id.in_([1, 2, 3])).order_by(Subtask.task_id, Subtask.order)),
+        ('Задачи по статусу', Task.query.filter_by(user_id=user_id, status='completed')
+            .with_entities(func.count(Task.id))),
+        ('Подзадачи задачи', Subtask.query
+            .filter_by(task_id=task_id).order_by(Subtask.order)),
+        ('Треки плейлиста', Track.query
+            .filter_by(playlist_id=playlist_id).order_by(Track.order)),
+        ('Ранг нового трека', db.session.query(Track.order)
+            .filter(Track.playlist_id == playlist_id).order_by(Track.order.desc()).limit(1)),
+        ('Сосед при перемещении трека', db.session.query(Track.order)
+            .filter(Track.playlist_id == playlist_id, Track.id != 1, Track.order >= 2.5)
+            .order_by(Track.order).limit(1)),
+        ('Топ игры на память', db.session.query(MemoryGameBest.user_id, User.username)
+            .join(User, User.id == MemoryGameBest.user_id)
+            .filter(MemoryGameBest.game_type == 'sequence')
+            .order_by(MemoryGameBest.level.desc(), MemoryGameBest.score.desc()).limit(10)),
+        ('Место в игре на память', db.session.query(func.count()).select_from(MemoryGameBest)
+            .filter(MemoryGameBest.game_type == 'sequence',
+                    db.tuple_(MemoryGameBest.level, MemoryGameBest.score) > (5, 100))),
+        ('Топ фокуса за неделю', db.session.query(FocusLeaderboard.user_id, User.username)
+            .join(User, User.id == FocusLeaderboard.user_id)
+            .filter(FocusLeaderboard.period_key == 'w2026-01-05')
+            .order_by(FocusLeaderboard.minutes.desc()).limit(100)),
+        ('Место в рейтинге фокуса', db.session.query(func.count()).select_from(FocusLeaderboard)
+            .filter(FocusLeaderboard.period_key == 'w2026-01-05', FocusLeaderboard.minutes > 120)),
+        ('Тепловая карта фокуса', db.session.query(
+                func.strftime('%w', TaskTimeLog.date), TaskTimeLog.hour, func.sum(TaskTimeLog.seconds))
+            .filter(TaskTimeLog.user_id == user_id, TaskTimeLog.date >= date(2026, 1, 1))
+            .group_by(func.strftime('%w', TaskTimeLog.date), TaskTimeLog.hour)),
+    ]
+
+
+def explain(query):
+    """Строки EXPLAIN QUERY PLAN для ORM-запроса"""
+    sql = query.statement.compile(dialect=db.engine.dialect, compile_kwargs={'literal_binds': True})
+    with db.engine.connect() as conn:
+        return [row[3] for row in conn.exec_driver_sql(f'EXPLAIN QUERY PLAN {sql}')]
+
+
+def is_full_scan(detail):
+    """Полный проход по таблице или всему индексу (SEARCH и временные B-деревья допустимы)"""
+    return detail.startswith('SCAN ') and not detail.startswith(('SCAN CONSTANT', 'SCAN SUBQUERY'))
+
+
+def main():
+    failed = []
+    try:
+        build_database()
+        with app.app_context():
+            print(f"База: {db.engine.url} (схема моделей + migrate_db, без ANALYZE)")
+            for name, query in hot_queries():
+                plan = explain(query)
+                scans = [detail for detail in plan if is_full_scan(detail)]
+                print(f"{'✗' if scans else '✓'} {name}")
+                for detail in plan:
+                    print(f"    {detail}")
+                if scans:
+                    failed.append(name)
+            db.engine.dispose()
+    finally:
+        shutil.rmtree(TMP_DIR, ignore_errors=True)
+
+    if failed:
+        print(f"\n❌ Полное сканирование таблиц: {', '.join(failed)}")
+        return 1
+    print("\n✅ Все частые запросы используют индексы")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
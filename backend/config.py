@@ -19,6 +19,52 @@ class Config:
         'connect_args': {'timeout': 30}
     }
     
+    # Поток событий чата (SSE) держит воркер всё время, пока чат открыт: включайте только
+    # с асинхронными воркерами (gevent, eventlet). Выключен - клиент опрашивает ?after_id=
+    CHAT_EVENTS_ENABLED = os.getenv('CHAT_EVENTS_ENABLED', 'false').lower() in ('1', 'true', 'yes')
+    # Опрос БД на сообщения из других воркеров, пинг с проверкой участия каждые N секунд,
+    # переподключение клиента по истечении срока
+    CHAT_EVENTS_POLL = float(os.getenv('CHAT_EVENTS_POLL', 2))
+    CHAT_EVENTS_HEARTBEAT = int(os.getenv('CHAT_EVENTS_HEARTBEAT', 20))
+    CHAT_EVENTS_MAX_SECONDS = int(os.getenv('CHAT_EVENTS_MAX_SECONDS', 60))
+    
+    # Кэш ролей участников чатов (в памяти процесса): размер и время жизни записи в секундах
+    CHAT_ACCESS_CACHE_SIZE = int(os.getenv('CHAT_ACCESS_CACHE_SIZE', 4096))
+    CHAT_ACCESS_CACHE_TTL = int(os.getenv('CHAT_ACCESS_CACHE_TTL', 30))
+    
+    # Онлайн-статус: пинги копятся в памяти и записываются в users.last_seen раз в N секунд
+    PRESENCE_FLUSH_INTERVAL = int(os.getenv('PRESENCE_FLUSH_INTERVAL', 30))
+    
+    # Статус «печатает» гаснет через N секунд без повторного сигнала
+    TYPING_TTL = int(os.getenv('TYPING_TTL', 6))
+    
+    # Кэш статистики (фокус, задачи, настроение): memory - в процессе, sqlite - общий файл для всех воркеров
+    STATS_CACHE_BACKEND = os.getenv('STATS_CACHE_BACKEND', 'memory')
+    STATS_CACHE_PATH = os.getenv('STATS_CACHE_PATH', os.path.join(instance_path, 'stats_cache.db'))
+    STATS_CACHE_SIZE = int(os.getenv('STATS_CACHE_SIZE', 2048))
+    STATS_CACHE_TTL = int(os.getenv('STATS_CACHE_TTL', 300))
+    
+    # Ответы по Idempotency-Key (TTL в секундах, по умолчанию сутки). По умолчанию sqlite - общий файл
+    # для всех воркеров: повтор, попавший в другой воркер, тоже найдёт ключ. memory - только при одном воркере
+    IDEMPOTENCY_BACKEND = os.getenv('IDEMPOTENCY_BACKEND', 'sqlite')
+    IDEMPOTENCY_PATH = os.getenv('IDEMPOTENCY_PATH', os.path.join(instance_path, 'idempotency.db'))
+    IDEMPOTENCY_SIZE = int(os.getenv('IDEMPOTENCY_SIZE', 10000))
+    IDEMPOTENCY_TTL = int(os.getenv('IDEMPOTENCY_TTL', 24 * 3600))
+    
+    # Рейтинги: сколько первых мест держать в памяти и как часто перечитывать их из БД
+    LEADERBOARD_SIZE = int(os.getenv('LEADERBOARD_SIZE', 10))
+    LEADERBOARD_TTL = int(os.getenv('LEADERBOARD_TTL', 60))
+    FOCUS_LEADERBOARD_SIZE = int(os.getenv('FOCUS_LEADERBOARD_SIZE', 100))
+    
+    # Список задач: наибольший размер страницы ?limit=
+    TASKS_PAGE_MAX = int(os.getenv('TASKS_PAGE_MAX', 500))
+    
+    # Пакетные изменения задач и подзадач: наибольшее число операций в запросе
+    BULK_MAX_OPERATIONS = int(os.getenv('BULK_MAX_OPERATIONS', 500))
+    
+    # Администраторы (служебные эндпоинты вроде /api/stats/cache): email через запятую
+    ADMIN_EMAILS = {e.strip().lower() for e in os.getenv('ADMIN_EMAILS', '').split(',') if e.strip()}
+    
     # Google OAuth
     GOOGLE_CLIENT_ID = os.getenv('GOOGLE_CLIENT_ID', '')
     GOOGLE_CLIENT_SECRET = os.getenv('GOOGLE_CLIENT_SECRET', '')
@@ -0,0 +1,95 @@
+"""
+Модуль событий сессии фокуса
+
+Таймер на клиенте копит события (distraction, pause, resume, heartbeat) и
+отправляет их пачкой: одна транзакция на пачку вместо запроса с коммитом на
+каждое отвлечение. У каждого события есть порядковый номер seq; принятые номера
+запоминаются в сессии, поэтому повторная отправка той же пачки (сбой сети,
+sendBeacon при закрытии вкладки) ничего не удваивает.
+
+Время фокуса записывается в task_time_logs по часам: heartbeat и pause
+закрывают интервал от tracked_until до момента события, интервалы пачки
+складываются по часам и записываются одним UPSERT. Интервал длиннее
+MAX_GAP без событий (вкладка спала, ноутбук закрыли) не засчитывается.
+Завершение сессии закрывает последний интервал (finish_tracking); у клиентов
+без событий это весь интервал сессии, но не больше её длительности.
+"""
+from datetime import datetime, timedelta, timezone
+
+from models import db, TaskTimeLog
+
+EVENT_TYPES = ('distraction', 'pause', 'resume', 'heartbeat')
+MAX_EVENTS = 500  # Событий в одной пачке
+MAX_GAP = timedelta(minutes=5)  # Больше без событий - таймер считаем остановленным
+
+
+def parse_events(raw_events, since_seq, now=None):
+    """
+    Проверить и отсортировать события клиента: [(seq, type, at)].
+    Уже принятые (seq <= since_seq) и некорректные события пропускаются,
+    время из будущего обрезается до now.
+    """
+    now = now or datetime.utcnow()
+    events = []
+    for raw in raw_events[:MAX_EVENTS]:
+        if not isinstance(raw, dict) or raw.get('type') not in EVENT_TYPES:
+            continue
+        try:
+            seq = int(raw['seq'])
+            at = datetime.fromisoformat(str(raw['at']).replace('Z', '+00:00'))  # 'Z' понимает только Python 3.11+
+        except (KeyError, TypeError, ValueError):
+            continue
+        if seq <= since_seq:
+            continue
+        if at.tzinfo is not None:
+            at = at.astimezone(timezone.utc).replace(tzinfo=None)
+        events.append((seq, raw['type'], min(at, now)))
+    events.sort(key=lambda event: event[0])
+    return events
+
+
+def track_until(session, at, intervals):
+    """Засчитать время фокуса от tracked_until до at (если таймер шёл): добавить интервал в intervals"""
+    start = session.tracked_until or session.started_at
+    if session.paused_at is None and at > start and at - start <= MAX_GAP:
+        intervals.append((start, at))
+    if at > start:
+        session.tracked_until = at
+
+
+def apply_events(session, events):
+    """
+    Применить события к сессии (без коммита).
+    Возвращает (число новых отвлечений, записано ли время в task_time_logs).
+    """
+    distractions = 0
+    intervals = []
+    for seq, event_type, at in events:
+        at = max(at, session.started_at)
+        if event_type == 'distraction':
+            distractions += 1
+        elif event_type == 'heartbeat':
+            track_until(session, at, intervals)
+        elif event_type == 'pause':
+            track_until(session, at, intervals)
+            session.paused_at = session.paused_at or at
+        elif event_type == 'resume' and session.paused_at is not None:
+            session.paused_at = None
+            session.tracked_until = max(at, session.tracked_until or at)
+        session.last_event_seq = seq
+
+    TaskTimeLog.add_intervals(session, intervals)
+    session.distractions = (session.distractions or 0) + distractions
+    return distractions, bool(intervals)
+
+
+def finish_tracking(session):
+    """Засчитать время от последнего события до конца сессии (вызывать один раз, при завершении)"""
+    start = session.tracked_until or session.started_at
+    if session.paused_at is None and session.ended_at and start:
+        tracked = db.session.query(db.func.coalesce(db.func.sum(TaskTimeLog.seconds), 0)).filter(
+            TaskTimeLog.session_id == session.id
+        ).scalar()
+        budget = max(0, (session.duration_minutes or 0) * 60 - tracked)
+        TaskTimeLog.add_intervals(session, [(start, min(session.ended_at, start + timedelta(seconds=budget)))])
+    session.tracked_until = session.ended_at
@@ -0,0 +1,86 @@
+"""
+Модуль рейтингов
+
+TopK - первые места одного рейтинга в памяти процесса. Список загружается
+из БД одним запросом с LIMIT по индексу и дальше обновляется на месте:
+результаты в рейтингах только растут, поэтому новый участник может попасть
+в топ лишь через offer(), и пересортировка всей таблицы не нужна.
+Изменения из других воркеров подхватываются перезагрузкой раз в ttl секунд.
+
+Место пользователя вне топа считается в БД запросом COUNT по тому же индексу
+(сколько результатов лучше), без чтения всей таблицы.
+"""
+import threading
+import time
+
+
+class TopK:
+    """Отсортированные первые size записей рейтинга; sort_key - ключ сортировки записи"""
+
+    def __init__(self, sort_key, size=10, ttl=60):
+        self.sort_key = sort_key
+        self.size = size
+        self.ttl = ttl
+        self._entries = None  # list[dict] с полем user_id, по возрастанию sort_key
+        self._loaded_at = 0.0
+        self._lock = threading.Lock()
+
+    def get(self, loader):
+        """Текущий топ; loader() - запрос к БД, вызывается при первом обращении и по TTL"""
+        with self._lock:
+            if self._entries is None or time.monotonic() - self._loaded_at >= self.ttl:
+                self._entries = sorted(loader(), key=self.sort_key)[:self.size]
+                self._loaded_at = time.monotonic()
+            return list(self._entries)
+
+    def offer(self, entry):
+        """Новый результат пользователя: заменить его запись и, если он в топе, переставить"""
+        with self._lock:
+            if self._entries is None:
+                return  # Ещё не загружен - загрузится уже с этим результатом
+            entries = [e for e in self._entries if e['user_id'] != entry['user_id']]
+            entries.append(entry)
+            entries.sort(key=self.sort_key)
+            self._entries = entries[:self.size]
+
+    def update_user(self, user_id, **fields):
+        """Обновить поля записи пользователя в топе (например, после смены имени)"""
+        with self._lock:
+            for entry in self._entries or ():
+                if entry['user_id'] == user_id:
+                    entry.update({k: v for k, v in fields.items() if k in entry})
+
+    def invalidate(self):
+        with self._lock:
+            self._entries = None
+
+
+class Leaderboards:
+    """Набор рейтингов по имени (например, 'memory:sequence'), создаются по требованию"""
+
+    def __init__(self, size=10, ttl=60):
+        self.size = size
+        self.ttl = ttl
+        self._boards = {}
+        self._lock = threading.Lock()
+
+    def board(self, name, sort_key, size=None):
+        """Рейтинг по имени; size - сколько мест держать (по умолчанию общий размер)"""
+        with self._lock:
+            board = self._boards.get(name)
+            if board is None:
+                board = self._boards[name] = TopK(sort_key, size=size or self.size, ttl=self.ttl)
+            return board
+
+    def retain(self, prefix, names):
+        """Удалить рейтинги с префиксом prefix, кроме names (например, прошедшие недели)"""
+        with self._lock:
+            for name in [n for n in self._boards if n.startswith(prefix) and n not in names]:
+                del self._boards[name]
+
+    def update_user(self, user_id, **fields):
+        """Обновить поля пользователя во всех рейтингах"""
+        with self._lock:
+            boards = list(self._boards.values())
+        for board in boards:
+            board.update_user(user_id, **fields)
@@ -2,10 +2,49 @@
 Скрипт миграции базы данных
 """
 import sqlite3
-import os
+import sys
 
-# Путь к базе данных
-db_path = os.path.join(os.path.dirname(__file__), 'instance', 'focus_app.db')
+from sqlalchemy.dialects import sqlite
+from sqlalchemy.schema import CreateIndex, CreateTable
+
+from config import Config
+from models import FocusLeaderboard, FocusRollup
+from search import SEARCH_INDEXES
+
+# Путь к базе данных: тот же файл, что использует приложение (можно передать первым аргументом)
+db_path = Config.SQLALCHEMY_DATABASE_URI.replace('sqlite:///', '', 1)
+
+# Составные индексы для частых запросов (имена совпадают с __table_args__ в models.py)
+HOT_PATH_INDEXES = [
+    ('ix_messages_chat_id_created_at', 'messages', 'chat_id, created_at'),
+    ('ix_messages_chat_id_sender_id', 'messages', 'chat_id, sender_id'),
+    ('ix_focus_sessions_user_id_started_at', 'focus_sessions', 'user_id, started_at, is_completed'),
+    ('ix_tasks_user_id_created_at', 'tasks', 'user_id, created_at'),
+    ('ix_tasks_user_id_status', 'tasks', 'user_id, status'),
+    ('ix_tasks_user_id_updated_at', 'tasks', 'user_id, updated_at'),
+    ('ix_subtasks_task_id_order', 'subtasks', 'task_id, "order"'),
+    ('ix_tracks_playlist_id_order', 'tracks', 'playlist_id, "order"'),
+    ('ix_users_username_nocase', 'users', 'username COLLATE NOCASE'),
+    ('ix_users_name_nocase', 'users', 'name COLLATE NOCASE'),
+    ('ix_blocked_users_user_id_blocked_user_id', 'blocked_users', 'user_id, blocked_user_id'),
+    ('ix_blocked_users_blocked_user_id', 'blocked_users', 'blocked_user_id'),
+    ('ix_task_time_logs_user_id_date', 'task_time_logs', 'user_id, date, hour, seconds'),
+]
+
+# Курсор прочтения участника {member} = последнее своё или уже прочитанное сообщение чата
+READ_CURSOR_SQL = """COALESCE((
+    SELECT MAX(m.id) FROM messages m
+    WHERE m.chat_id = {member}.chat_id
+      AND (m.sender_id = {member}.user_id OR m.is_read = 1)
+), 0)"""
+
+
+def create_model_table(cursor, model):
+    """Создать таблицу модели и её индексы, если их ещё нет (DDL берётся из models.py)"""
+    dialect = sqlite.dialect()
+    cursor.execute(str(CreateTable(model.__table__, if_not_exists=True).compile(dialect=dialect)))
+    for index in model.__table__.indexes:
+        cursor.execute(str(CreateIndex(index, if_not_exists=True).compile(dialect=dialect)))
 
 
 def migrate():
@@ -26,6 +65,9 @@ def migrate():
         ('members_can_pin', 'BOOLEAN DEFAULT 0'),
         ('slow_mode', 'INTEGER DEFAULT 0'),
         ('owner_id', 'INTEGER'),
+        ('last_message_id', 'INTEGER'),
+        ('last_activity_at', 'DATETIME'),
+        ('member_count', 'INTEGER DEFAULT 0'),
     ]
     
     cursor.execute("PRAGMA table_info(chats)")
@@ -40,6 +82,162 @@ def migrate():
             except sqlite3.OperationalError as e:
                 print(f"✗ chats.{col_name}: {e}")
     
+    # === Единая таблица участников chat_members_v2 и курсоры прочтения ===
+    # Каждая строка пишется один раз: курсоры - только строкам, что уже были в chat_members_v2,
+    # перенесённые из chat_members получают курсор сразу при вставке
+    print("\n=== Участники чатов и курсоры прочтения ===")
+    cursor.execute("PRAGMA table_info(chat_members_v2)")
+    member_columns = {row[1] for row in cursor.fetchall()}
+    if member_columns and 'last_read_message_id' not in member_columns:
+        cursor.execute("ALTER TABLE chat_members_v2 ADD COLUMN last_read_message_id INTEGER DEFAULT 0")
+        cursor.execute(
+            f"UPDATE chat_members_v2 SET last_read_message_id = {READ_CURSOR_SQL.format(member='chat_members_v2')}"
+        )
+        print(f"✓ chat_members_v2.last_read_message_id (курсоров: {cursor.rowcount})")
+    
+    cursor.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name = 'chat_members'")
+    if cursor.fetchone():
+        # Старая таблица больше не используется приложением (личные чаты жили только в ней)
+        cursor.execute(f"""
+            INSERT INTO chat_members_v2 (chat_id, user_id, role, joined_at, is_muted, can_send_messages, can_send_media, last_read_message_id)
+            SELECT cm.chat_id, cm.user_id, 'member', CURRENT_TIMESTAMP, 0, 1, 1, {READ_CURSOR_SQL.format(member='cm')}
+            FROM chat_members cm
+            WHERE NOT EXISTS (
+                SELECT 1 FROM chat_members_v2 v2
+                WHERE v2.chat_id = cm.chat_id AND v2.user_id = cm.user_id
+            )
+        """)
+        print(f"✓ Перенесено из chat_members: {cursor.rowcount}")
+    
+    # Удаляем дубли (chat_id, user_id), оставляя самую раннюю строку
+    cursor.execute("""
+        DELETE FROM chat_members_v2 WHERE id NOT IN (
+            SELECT MIN(id) FROM chat_members_v2 GROUP BY chat_id, user_id
+        )
+    """)
+    if cursor.rowcount:
+        print(f"✓ Удалено дублей: {cursor.rowcount}")
+    cursor.execute("CREATE UNIQUE INDEX IF NOT EXISTS uq_chat_members_v2_chat_user ON chat_members_v2 (chat_id, user_id)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS ix_chat_members_v2_user_id ON chat_members_v2 (user_id)")
+    print("✓ Индексы (chat_id, user_id) и (user_id)")
+    
+    # === Сводка чатов и счётчики непрочитанных ===
+    print("\n=== Сводка чатов ===")
+    cursor.execute("PRAGMA table_info(chat_members_v2)")
+    member_columns = {row[1] for row in cursor.fetchall()}
+    if 'last_message_id' not in existing_columns or 'unread_count' not in member_columns:
+        if 'unread_count' not in member_columns:
+            cursor.execute("ALTER TABLE chat_members_v2 ADD COLUMN unread_count INTEGER DEFAULT 0")
+            print("✓ chat_members_v2.unread_count")
+        
+        cursor.execute("""
+            UPDATE chats SET
+                last_message_id = (SELECT MAX(m.id) FROM messages m WHERE m.chat_id = chats.id),
+                member_count = (SELECT COUNT(*) FROM chat_members_v2 cm WHERE cm.chat_id = chats.id)
+        """)
+        cursor.execute("""
+            UPDATE chats SET last_activity_at = COALESCE(
+                (SELECT m.created_at FROM messages m WHERE m.id = chats.last_message_id),
+                created_at
+            )
+        """)
+        print(f"✓ Сводка заполнена для чатов: {cursor.rowcount}")
+        
+        cursor.execute("""
+            UPDATE chat_members_v2 SET unread_count = (
+                SELECT COUNT(*) FROM messages m
+                WHERE m.chat_id = chat_members_v2.chat_id
+                  AND m.sender_id != chat_members_v2.user_id
+                  AND m.id > COALESCE(chat_members_v2.last_read_message_id, 0)
+            )
+        """)
+        print(f"✓ Счётчики непрочитанных: {cursor.rowcount}")
+    cursor.execute("CREATE INDEX IF NOT EXISTS ix_chats_last_activity_at ON chats (last_activity_at)")
+    
+    # === Водяной знак ночного увядания деревьев ===
+    print("\n=== Увядание деревьев фокуса ===")
+    cursor.execute("PRAGMA table_info(focus_trees)")
+    tree_columns = {row[1] for row in cursor.fetchall()}
+    if tree_columns and 'last_decay_date' not in tree_columns:
+        cursor.execute("ALTER TABLE focus_trees ADD COLUMN last_decay_date DATE")
+        # Раньше увядание списывалось при открытии дерева - считаем его учтённым по сегодня
+        cursor.execute("UPDATE focus_trees SET last_decay_date = date('now')")
+        print(f"✓ focus_trees.last_decay_date (деревьев: {cursor.rowcount})")
+    else:
+        print("- focus_trees.last_decay_date уже есть")
+    
+    # === Время изменения задач (для синхронизации списка) ===
+    print("\n=== Время изменения задач ===")
+    cursor.execute("PRAGMA table_info(tasks)")
+    task_columns = {row[1] for row in cursor.fetchall()}
+    if task_columns and 'updated_at' not in task_columns:
+        cursor.execute("ALTER TABLE tasks ADD COLUMN updated_at DATETIME")
+        cursor.execute("UPDATE tasks SET updated_at = COALESCE(completed_at, created_at)")
+        print(f"✓ tasks.updated_at (задач: {cursor.rowcount})")
+    else:
+        print("- tasks.updated_at уже есть")
+    
+    # === События сессий фокуса и почасовой лог времени ===
+    print("\n=== События сессий фокуса ===")
+    cursor.execute("PRAGMA table_info(focus_sessions)")
+    session_columns = {row[1] for row in cursor.fetchall()}
+    for col_name, col_type in [('paused_at', 'DATETIME'), ('tracked_until', 'DATETIME'), ('last_event_seq', 'INTEGER DEFAULT 0')]:
+        if session_columns and col_name not in session_columns:
+            cursor.execute(f"ALTER TABLE focus_sessions ADD COLUMN {col_name} {col_type}")
+            print(f"✓ focus_sessions.{col_name}")
+    cursor.execute("PRAGMA table_info(task_time_logs)")
+    log_columns = {row[1] for row in cursor.fetchall()}
+    if log_columns:
+        if 'seconds' not in log_columns:
+            cursor.execute("ALTER TABLE task_time_logs ADD COLUMN seconds INTEGER NOT NULL DEFAULT 0")
+            cursor.execute("UPDATE task_time_logs SET seconds = minutes * 60")
+            print("✓ task_time_logs.seconds")
+        cursor.execute(
+            "CREATE UNIQUE INDEX IF NOT EXISTS uq_task_time_logs_session_hour ON task_time_logs (session_id, date, hour)"
+        )
+        print("✓ uq_task_time_logs_session_hour")
+    
+    # === Составные индексы для частых запросов ===
+    print("\n=== Составные индексы ===")
+    cursor.execute("SELECT name FROM sqlite_master WHERE type = 'table'")
+    existing_tables = {row[0] for row in cursor.fetchall()}
+    for index_name, table, columns in HOT_PATH_INDEXES:
+        if table not in existing_tables:
+            print(f"- {index_name}: нет таблицы {table}")
+            continue
+        cursor.execute(f"CREATE INDEX IF NOT EXISTS {index_name} ON {table} ({columns})")
+        print(f"✓ {index_name}")
+    cursor.execute("ANALYZE")
+    
+    # === Полнотекстовый поиск по сообщениям и пользователям ===
+    print("\n=== Поисковые индексы (FTS5) ===")
+    for table, ddl, rebuild in SEARCH_INDEXES:
+        cursor.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name = ?", (table,))
+        fts_exists = cursor.fetchone() is not None
+        try:
+            for statement in ddl:
+                cursor.execute(statement)
+            if not fts_exists:
+                cursor.execute(rebuild)
+                print(f"✓ Индекс {table} создан и заполнен")
+            else:
+                print(f"- {table} уже существует")
+        except sqlite3.OperationalError as e:
+            print(f"- {table}: {e}")
+    
+    # === Агрегаты фокуса из истории сессий ===
+    # Пересборка целиком: повторный запуск даёт те же строки, а статистика и
+    # рейтинги не пустуют сразу после деплоя
+    print("\n=== Агрегаты фокуса ===")
+    create_model_table(cursor, FocusRollup)
+    cursor.execute("DELETE FROM focus_rollups")
+    cursor.execute(FocusRollup.REBUILD_SQL.format(where=''))
+    print(f"✓ focus_rollups (строк: {cursor.rowcount})")
+    create_model_table(cursor, FocusLeaderboard)
+    cursor.execute("DELETE FROM focus_leaderboard")
+    cursor.execute(FocusLeaderboard.REBUILD_SQL)
+    print(f"✓ focus_leaderboard (строк: {cursor.rowcount})")
+    
     # === Создание таблицы yandex_disk_tokens ===
     print("\n=== Создание таблицы yandex_disk_tokens ===")
     try:
@@ -88,4 +286,6 @@ def migrate():
 
 
 if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        db_path = sys.argv[1]
     migrate()
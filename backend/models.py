@@ -1,6 +1,7 @@
 from flask_sqlalchemy import SQLAlchemy
 from flask_login import UserMixin
-from datetime import datetime
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from datetime import datetime, timedelta
 
 db = SQLAlchemy()
 
@@ -10,16 +11,13 @@ friendships = db.Table('friendships',
     db.Column('friend_id', db.Integer, db.ForeignKey('users.id'), primary_key=True)
 )
 
-# Участники чата (устаревшая таблица, используется ChatMember)
-chat_members = db.Table('chat_members',
-    db.Column('user_id', db.Integer, db.ForeignKey('users.id'), primary_key=True),
-    db.Column('chat_id', db.Integer, db.ForeignKey('chats.id'), primary_key=True)
-)
-
-
 class ChatMember(db.Model):
-    """Участники чата с ролями и настройками"""
+    """Участники чата с ролями и настройками (единственный источник членства)"""
     __tablename__ = 'chat_members_v2'
+    __table_args__ = (
+        db.UniqueConstraint('chat_id', 'user_id', name='uq_chat_members_v2_chat_user'),
+        db.Index('ix_chat_members_v2_user_id', 'user_id'),
+    )
     
     id = db.Column(db.Integer, primary_key=True)
     chat_id = db.Column(db.Integer, db.ForeignKey('chats.id'), nullable=False)
@@ -30,13 +28,32 @@ class ChatMember(db.Model):
     muted_until = db.Column(db.DateTime, nullable=True)  # Мут до определённого времени
     can_send_messages = db.Column(db.Boolean, default=True)  # Может отправлять сообщения
     can_send_media = db.Column(db.Boolean, default=True)  # Может отправлять медиа
+    last_read_message_id = db.Column(db.Integer, default=0)  # Курсор прочтения: id последнего прочитанного сообщения
+    unread_count = db.Column(db.Integer, default=0)  # Счётчик непрочитанных (поддерживается при отправке/чтении)
     
     chat = db.relationship('Chat', backref=db.backref('members_v2', lazy='dynamic', cascade='all, delete-orphan'))
     user = db.relationship('User', backref=db.backref('chat_memberships', lazy='dynamic'))
+    
+    @classmethod
+    def get(cls, chat_id, user_id):
+        """Строка участника по уникальному индексу (chat_id, user_id)"""
+        return cls.query.filter_by(chat_id=chat_id, user_id=user_id).first()
+    
+    @classmethod
+    def is_member(cls, chat_id, user_id):
+        """Проверка членства одним EXISTS без загрузки списка участников"""
+        return db.session.query(
+            db.exists().where(cls.chat_id == chat_id, cls.user_id == user_id)
+        ).scalar()
 
 
 class User(UserMixin, db.Model):
     __tablename__ = 'users'
+    __table_args__ = (
+        # Префиксный поиск (LIKE 'q%') без учёта регистра идёт по этим индексам
+        db.Index('ix_users_username_nocase', db.text('username COLLATE NOCASE')),
+        db.Index('ix_users_name_nocase', db.text('name COLLATE NOCASE')),
+    )
     
     id = db.Column(db.Integer, primary_key=True)
     email = db.Column(db.String(120), unique=True, nullable=False)
@@ -75,6 +92,10 @@ class User(UserMixin, db.Model):
 # Таблица блокировок
 class BlockedUser(db.Model):
     __tablename__ = 'blocked_users'
+    __table_args__ = (
+        db.Index('ix_blocked_users_user_id_blocked_user_id', 'user_id', 'blocked_user_id'),
+        db.Index('ix_blocked_users_blocked_user_id', 'blocked_user_id'),
+    )
     
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
@@ -87,6 +108,11 @@ class BlockedUser(db.Model):
 
 class Task(db.Model):
     __tablename__ = 'tasks'
+    __table_args__ = (
+        db.Index('ix_tasks_user_id_created_at', 'user_id', 'created_at'),
+        db.Index('ix_tasks_user_id_status', 'user_id', 'status'),
+        db.Index('ix_tasks_user_id_updated_at', 'user_id', 'updated_at'),
+    )
     
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
@@ -101,6 +127,7 @@ class Task(db.Model):
     ambient_sound = db.Column(db.String(50), default='none')  # Фоновый звук
     playlist_id = db.Column(db.Integer, db.ForeignKey('playlists.id'), nullable=True)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)  # В том числе изменения подзадач
     completed_at = db.Column(db.DateTime, nullable=True)
 
 
@@ -118,6 +145,9 @@ class Playlist(db.Model):
 
 class Track(db.Model):
     __tablename__ = 'tracks'
+    __table_args__ = (
+        db.Index('ix_tracks_playlist_id_order', 'playlist_id', 'order'),
+    )
     
     id = db.Column(db.Integer, primary_key=True)
     playlist_id = db.Column(db.Integer, db.ForeignKey('playlists.id'), nullable=False)
@@ -125,7 +155,7 @@ class Track(db.Model):
     artist = db.Column(db.String(200), default='')
     url = db.Column(db.String(500), nullable=False)  # YouTube/Spotify URL
     duration = db.Column(db.Integer, default=0)  # секунды
-    order = db.Column(db.Integer, default=0)
+    order = db.Column(db.Float, default=0)  # Дробный ранг, см. ranking.py
 
 
 class Note(db.Model):
@@ -170,13 +200,23 @@ class Chat(db.Model):
     
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     
-    members = db.relationship('User', secondary=chat_members, backref='chats')
+    # Сводка для списка чатов (обновляется при отправке/удалении сообщений и смене участников)
+    last_message_id = db.Column(db.Integer, nullable=True)
+    last_activity_at = db.Column(db.DateTime, default=datetime.utcnow, index=True)
+    member_count = db.Column(db.Integer, default=0)
+    
+    # Только для чтения: членство изменяется через ChatMember
+    members = db.relationship('User', secondary='chat_members_v2', viewonly=True)
     messages = db.relationship('Message', backref='chat', lazy='dynamic', cascade='all, delete-orphan')
     owner = db.relationship('User', foreign_keys=[owner_id], backref='owned_chats')
 
 
 class Message(db.Model):
     __tablename__ = 'messages'
+    __table_args__ = (
+        db.Index('ix_messages_chat_id_created_at', 'chat_id', 'created_at'),
+        db.Index('ix_messages_chat_id_sender_id', 'chat_id', 'sender_id'),
+    )
     
     id = db.Column(db.Integer, primary_key=True)
     chat_id = db.Column(db.Integer, db.ForeignKey('chats.id'), nullable=False)
@@ -184,7 +224,7 @@ class Message(db.Model):
     content = db.Column(db.Text, nullable=False)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     edited_at = db.Column(db.DateTime, nullable=True)  # Время редактирования
-    is_read = db.Column(db.Boolean, default=False)
+    is_read = db.Column(db.Boolean, default=False)  # Устарело: прочтение хранится в ChatMember.last_read_message_id
     reply_to_id = db.Column(db.Integer, db.ForeignKey('messages.id'), nullable=True)  # Ответ на сообщение
     
     sender = db.relationship('User', backref='messages')
@@ -194,6 +234,9 @@ class Message(db.Model):
 class FocusSession(db.Model):
     """Сессия фокусировки (работа с таймером)"""
     __tablename__ = 'focus_sessions'
+    __table_args__ = (
+        db.Index('ix_focus_sessions_user_id_started_at', 'user_id', 'started_at', 'is_completed'),
+    )
     
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
@@ -205,10 +248,26 @@ class FocusSession(db.Model):
     is_completed = db.Column(db.Boolean, default=False)
     distractions = db.Column(db.Integer, default=0)  # Количество отвлечений
     tree_growth = db.Column(db.Integer, default=0)  # Рост дерева за сессию
+    paused_at = db.Column(db.DateTime, nullable=True)  # На паузе с этого момента (None - таймер идёт)
+    tracked_until = db.Column(db.DateTime, nullable=True)  # По какой момент время записано в task_time_logs
+    last_event_seq = db.Column(db.Integer, default=0)  # Последнее принятое событие клиента (для повторов)
     
     user = db.relationship('User', backref='focus_sessions')
     task = db.relationship('Task', backref='focus_sessions')
     playlist = db.relationship('Playlist', backref='focus_sessions')
+    
+    # То же в SQL (FocusLeaderboard.REBUILD_SQL): секунды округляются до мс против погрешности julianday
+    ACTUAL_MINUTES_SQL = """
+        CASE WHEN ended_at IS NOT NULL
+             THEN CAST(ROUND((julianday(ended_at) - julianday(started_at)) * 86400, 3) / 60 AS INTEGER)
+             ELSE duration_minutes END
+    """
+    
+    def actual_minutes(self):
+        """Фактическая длительность в минутах (дерево и рейтинги); без времени начала или конца - плановая"""
+        if self.started_at and self.ended_at:
+            return int((self.ended_at - self.started_at).total_seconds() / 60)
+        return self.duration_minutes
 
 
 class FocusTree(db.Model):
@@ -227,9 +286,173 @@ class FocusTree(db.Model):
     tree_type = db.Column(db.String(20), default='oak')  # Тип дерева
     garden_level = db.Column(db.Integer, default=0)  # Уровень сада (растения вокруг дерева)
     garden_exp = db.Column(db.Integer, default=0)  # Опыт сада
+    last_decay_date = db.Column(db.Date, nullable=True)  # По какую дату уже учтено увядание
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     
     user = db.relationship('User', backref=db.backref('focus_tree', uselist=False))
+    
+    DECAY_PER_DAY = 5  # -5 HP за каждый день без сессии (кроме первого)
+    DECAY_MIN_HEALTH = 10  # Ниже этого дерево от увядания не опускается
+    
+    def decay_days(self, today):
+        """Сколько дней увядания ещё не учтено на дату today"""
+        if not self.last_session_date:
+            return 0
+        charged_through = self.last_session_date + timedelta(days=1)  # Первый день без сессии бесплатный
+        if self.last_decay_date and self.last_decay_date > charged_through:
+            charged_through = self.last_decay_date
+        return max(0, (today - charged_through).days)
+    
+    def decayed(self, today):
+        """(здоровье, streak) с учётом ещё не применённого увядания, без записи в БД"""
+        days = self.decay_days(today)
+        if not days:
+            return self.health, self.streak_days
+        health = self.health
+        if health > self.DECAY_MIN_HEALTH:
+            health = max(self.DECAY_MIN_HEALTH, health - days * self.DECAY_PER_DAY)
+        return health, 0
+    
+    def apply_decay(self, today):
+        """Применить неучтённое увядание к этой строке (перед изменением дерева)"""
+        if self.decay_days(today):
+            self.health, self.streak_days = self.decayed(today)
+            self.last_decay_date = today
+    
+    @classmethod
+    def decay_all(cls, today):
+        """
+        Увядание всех деревьев на дату today одним UPDATE (то же, что decayed()).
+        Водяной знак last_decay_date делает повторный запуск за ту же дату пустым.
+        """
+        charged_through = "MAX(COALESCE(last_decay_date, ''), date(last_session_date, '+1 day'))"
+        result = db.session.execute(db.text(f"""
+            UPDATE focus_trees SET
+                health = CASE WHEN health > :min_health
+                    THEN MAX(:min_health, health - :per_day *
+                             CAST(julianday(:today) - julianday({charged_through}) AS INTEGER))
+                    ELSE health END,
+                streak_days = 0,
+                last_decay_date = :today
+            WHERE last_session_date IS NOT NULL AND {charged_through} < :today
+        """), {'today': today.isoformat(), 'min_health': cls.DECAY_MIN_HEALTH, 'per_day': cls.DECAY_PER_DAY})
+        return result.rowcount
+
+
+class FocusRollup(db.Model):
+    """Почасовые агрегаты завершённых сессий фокуса (для статистики без чтения focus_sessions)"""
+    __tablename__ = 'focus_rollups'
+    
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), primary_key=True)
+    day = db.Column(db.Date, primary_key=True)  # Дата начала сессии (UTC)
+    hour = db.Column(db.Integer, primary_key=True)  # Час начала сессии 0-23 (UTC)
+    minutes = db.Column(db.Integer, nullable=False, default=0)
+    sessions = db.Column(db.Integer, nullable=False, default=0)
+    
+    # Пересборка из focus_sessions (rebuild() и migrate_db); {where} - отбор по пользователю
+    REBUILD_SQL = """
+        INSERT INTO focus_rollups (user_id, day, hour, minutes, sessions)
+        SELECT user_id, date(started_at), CAST(strftime('%H', started_at) AS INTEGER),
+               SUM(duration_minutes), COUNT(*)
+        FROM focus_sessions
+        WHERE is_completed = 1 AND started_at IS NOT NULL {where}
+        GROUP BY user_id, date(started_at), CAST(strftime('%H', started_at) AS INTEGER)
+    """
+    
+    @classmethod
+    def add_session(cls, user_id, started_at, minutes):
+        """Прибавить завершённую сессию к агрегату её часа (UPSERT без чтения)"""
+        stmt = sqlite_insert(cls).values(
+            user_id=user_id,
+            day=started_at.date(),
+            hour=started_at.hour,
+            minutes=minutes,
+            sessions=1
+        )
+        db.session.execute(stmt.on_conflict_do_update(
+            index_elements=['user_id', 'day', 'hour'],
+            set_={'minutes': cls.minutes + stmt.excluded.minutes, 'sessions': cls.sessions + 1}
+        ))
+    
+    @classmethod
+    def rebuild(cls, user_id=None):
+        """Пересобрать агрегаты из focus_sessions одним INSERT ... SELECT"""
+        where = 'AND user_id = :user_id' if user_id else ''
+        db.session.execute(db.text(f'DELETE FROM focus_rollups WHERE 1 = 1 {where}'), {'user_id': user_id})
+        result = db.session.execute(db.text(cls.REBUILD_SQL.format(where=where)), {'user_id': user_id})
+        return result.rowcount
+
+
+class FocusLeaderboard(db.Model):
+    """Минуты фокуса пользователя за неделю, месяц и всё время (для рейтингов)"""
+    __tablename__ = 'focus_leaderboard'
+    __table_args__ = (
+        # Топ и место в рейтинге периода: WHERE period_key = ? ORDER BY minutes DESC
+        db.Index('ix_focus_leaderboard_rank', 'period_key', 'minutes'),
+    )
+    
+    period_key = db.Column(db.String(16), primary_key=True)  # all, w2026-10-12 (понедельник), m2026-10
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), primary_key=True)
+    minutes = db.Column(db.Integer, nullable=False, default=0)
+    sessions = db.Column(db.Integer, nullable=False, default=0)
+    
+    @staticmethod
+    def key_for(period, day):
+        """Ключ периода (week, month, all), в который попадает дата"""
+        if period == 'week':
+            return 'w' + (day - timedelta(days=day.weekday())).isoformat()
+        if period == 'month':
+            return 'm' + day.strftime('%Y-%m')
+        return 'all'
+    
+    @classmethod
+    def add_session(cls, user_id, started_at, minutes):
+        """Прибавить сессию ко всем периодам одним UPSERT; возвращает [(period_key, minutes, sessions)]"""
+        stmt = sqlite_insert(cls).values([{
+            'period_key': cls.key_for(period, started_at.date()),
+            'user_id': user_id,
+            'minutes': minutes,
+            'sessions': 1
+        } for period in ('week', 'month', 'all')])
+        stmt = stmt.on_conflict_do_update(
+            index_elements=['period_key', 'user_id'],
+            set_={'minutes': cls.minutes + stmt.excluded.minutes, 'sessions': cls.sessions + 1}
+        ).returning(cls.period_key, cls.minutes, cls.sessions)
+        return [tuple(row) for row in db.session.execute(stmt)]
+    
+    @classmethod
+    def rank(cls, period_key, minutes):
+        """Место в рейтинге периода: 1 + число пользователей с большим временем (счёт по индексу)"""
+        better = db.session.query(db.func.count()).select_from(cls).filter(
+            cls.period_key == period_key,
+            cls.minutes > minutes
+        ).scalar()
+        return better + 1
+    
+    # Пересборка из focus_sessions по фактическим минутам, как у дерева (rebuild() и migrate_db)
+    REBUILD_SQL = f"""
+        WITH completed AS (
+            SELECT user_id, date(started_at) AS day, {FocusSession.ACTUAL_MINUTES_SQL} AS minutes
+            FROM focus_sessions
+            WHERE is_completed = 1 AND started_at IS NOT NULL
+        )
+        INSERT INTO focus_leaderboard (period_key, user_id, minutes, sessions)
+        SELECT period_key, user_id, SUM(minutes), COUNT(*) FROM (
+            SELECT 'w' || date(day, 'weekday 0', '-6 days') AS period_key, user_id, minutes FROM completed
+            UNION ALL
+            SELECT 'm' || strftime('%Y-%m', day), user_id, minutes FROM completed
+            UNION ALL
+            SELECT 'all', user_id, minutes FROM completed
+        )
+        GROUP BY period_key, user_id
+    """
+    
+    @classmethod
+    def rebuild(cls):
+        """Пересобрать рейтинги из focus_sessions"""
+        db.session.execute(db.text('DELETE FROM focus_leaderboard'))
+        result = db.session.execute(db.text(cls.REBUILD_SQL))
+        return result.rowcount
 
 
 class FocusSettings(db.Model):
@@ -268,12 +491,15 @@ class FocusSettings(db.Model):
 class Subtask(db.Model):
     """Подзадачи для задач"""
     __tablename__ = 'subtasks'
+    __table_args__ = (
+        db.Index('ix_subtasks_task_id_order', 'task_id', 'order'),
+    )
     
     id = db.Column(db.Integer, primary_key=True)
     task_id = db.Column(db.Integer, db.ForeignKey('tasks.id'), nullable=False)
     title = db.Column(db.String(200), nullable=False)
     is_completed = db.Column(db.Boolean, default=False)
-    order = db.Column(db.Integer, default=0)
+    order = db.Column(db.Float, default=0)  # Дробный ранг, см. ranking.py
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     
     task = db.relationship('Task', backref=db.backref('subtasks', lazy='dynamic', cascade='all, delete-orphan'))
@@ -318,14 +544,20 @@ class TaskTemplate(db.Model):
 
 
 class TaskTimeLog(db.Model):
-    """Детальный лог времени по задачам"""
+    """Детальный лог времени по задачам: одна строка на сессию и час"""
     __tablename__ = 'task_time_logs'
+    __table_args__ = (
+        db.UniqueConstraint('session_id', 'date', 'hour', name='uq_task_time_logs_session_hour'),
+        # Тепловая карта и разбивка по часам: покрывающий индекс, таблица не читается
+        db.Index('ix_task_time_logs_user_id_date', 'user_id', 'date', 'hour', 'seconds'),
+    )
     
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
     task_id = db.Column(db.Integer, db.ForeignKey('tasks.id'), nullable=True)
     session_id = db.Column(db.Integer, db.ForeignKey('focus_sessions.id'), nullable=True)
     minutes = db.Column(db.Integer, nullable=False)
+    seconds = db.Column(db.Integer, nullable=False, default=0)  # Точное время; minutes = seconds // 60
     date = db.Column(db.Date, default=datetime.utcnow)
     hour = db.Column(db.Integer, default=0)  # Час дня (0-23) для почасовой статистики
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
@@ -333,6 +565,40 @@ class TaskTimeLog(db.Model):
     user = db.relationship('User', backref=db.backref('time_logs', lazy='dynamic'))
     task = db.relationship('Task', backref=db.backref('time_logs', lazy='dynamic'))
     session = db.relationship('FocusSession', backref=db.backref('time_logs', lazy='dynamic'))
+    
+    @classmethod
+    def add_intervals(cls, session, intervals):
+        """
+        Разнести интервалы фокуса [(start, end)] по часам и прибавить к строкам сессии.
+        Интервалы одного часа складываются заранее - один UPSERT на все интервалы.
+        """
+        by_hour = {}
+        for start, end in intervals:
+            while start < end:
+                hour_end = start.replace(minute=0, second=0, microsecond=0) + timedelta(hours=1)
+                chunk_end = min(end, hour_end)
+                key = (start.date(), start.hour)
+                by_hour[key] = by_hour.get(key, 0) + (chunk_end - start).total_seconds()
+                start = chunk_end
+        # Округляем суммы часов, а не куски: иначе на границе часа теряется по секунде
+        by_hour = {key: round(seconds) for key, seconds in by_hour.items() if round(seconds) > 0}
+        if not by_hour:
+            return
+        
+        stmt = sqlite_insert(cls).values([{
+            'user_id': session.user_id,
+            'task_id': session.task_id,
+            'session_id': session.id,
+            'date': day,
+            'hour': hour,
+            'seconds': seconds,
+            'minutes': seconds // 60
+        } for (day, hour), seconds in by_hour.items()])
+        total = cls.seconds + stmt.excluded.seconds
+        db.session.execute(stmt.on_conflict_do_update(
+            index_elements=['session_id', 'date', 'hour'],
+            set_={'seconds': total, 'minutes': db.cast(total / 60, db.Integer)}
+        ))
 
 
 class Achievement(db.Model):
@@ -347,6 +613,18 @@ class Achievement(db.Model):
     user = db.relationship('User', backref=db.backref('achievements', lazy='dynamic'))
 
 
+class AchievementProgress(db.Model):
+    """Счётчики для проверки достижений (меняются на дельту при событиях)"""
+    __tablename__ = 'achievement_progress'
+
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), primary_key=True)
+    tasks_completed = db.Column(db.Integer, default=0, nullable=False)
+    gratitude_entries = db.Column(db.Integer, default=0, nullable=False)
+    mood_entries = db.Column(db.Integer, default=0, nullable=False)
+    memory_best_level = db.Column(db.Integer, default=0, nullable=False)
+    unlocked = db.Column(db.Text, default='', nullable=False)  # Открытые типы через запятую
+
+
 class GratitudeEntry(db.Model):
     """Журнал благодарности"""
     __tablename__ = 'gratitude_entries'
@@ -375,6 +653,65 @@ class MemoryGameScore(db.Model):
     user = db.relationship('User', backref=db.backref('game_scores', lazy='dynamic'))
 
 
+class MemoryGameBest(db.Model):
+    """Лучший результат пользователя в каждой игре (для рейтинга без GROUP BY по всем играм)"""
+    __tablename__ = 'memory_game_best'
+    __table_args__ = (
+        # Топ и место в рейтинге: WHERE game_type = ? ORDER BY level DESC, score DESC
+        db.Index('ix_memory_game_best_rank', 'game_type', 'level', 'score'),
+    )
+
+    game_type = db.Column(db.String(50), primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), primary_key=True)
+    level = db.Column(db.Integer, nullable=False, default=1)
+    score = db.Column(db.Integer, nullable=False, default=0)
+    achieved_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+    @classmethod
+    def record(cls, user_id, game_type, level, score):
+        """Учесть результат игры; True, если это новый лучший результат пользователя"""
+        stmt = sqlite_insert(cls).values(
+            game_type=game_type,
+            user_id=user_id,
+            level=level,
+            score=score,
+            achieved_at=datetime.utcnow()
+        )
+        excluded = stmt.excluded
+        result = db.session.execute(stmt.on_conflict_do_update(
+            index_elements=['game_type', 'user_id'],
+            set_={'level': excluded.level, 'score': excluded.score, 'achieved_at': excluded.achieved_at},
+            where=db.tuple_(excluded.level, excluded.score) > db.tuple_(cls.level, cls.score)
+        ))
+        return result.rowcount > 0
+
+    @classmethod
+    def rank(cls, game_type, level, score):
+        """Место результата в рейтинге: 1 + число лучших результатов (счёт по индексу)"""
+        better = db.session.query(db.func.count()).select_from(cls).filter(
+            cls.game_type == game_type,
+            db.tuple_(cls.level, cls.score) > (level, score)
+        ).scalar()
+        return better + 1
+
+    @classmethod
+    def rebuild(cls):
+        """Пересобрать лучшие результаты из memory_game_scores"""
+        db.session.execute(db.text('DELETE FROM memory_game_best'))
+        result = db.session.execute(db.text("""
+            INSERT INTO memory_game_best (game_type, user_id, level, score, achieved_at)
+            SELECT game_type, user_id, level, score, played_at FROM (
+                SELECT game_type, user_id, COALESCE(level, 1) AS level, score, played_at,
+                       ROW_NUMBER() OVER (
+                           PARTITION BY game_type, user_id
+                           ORDER BY COALESCE(level, 1) DESC, score DESC, played_at
+                       ) AS place
+                FROM memory_game_scores
+            ) WHERE place = 1
+        """))
+        return result.rowcount
+
+
 class YandexDiskToken(db.Model):
     """Токены Яндекс.Диска для пользователей"""
     __tablename__ = 'yandex_disk_tokens'
@@ -0,0 +1,93 @@
+"""
+Модуль онлайн-статуса пользователей и индикаторов «печатает»
+
+Пинги /api/ping копятся в памяти процесса и записываются в users.last_seen
+пачкой не чаще раза в PRESENCE_FLUSH_INTERVAL секунд, а не отдельной
+транзакцией на каждый пинг каждой вкладки. Сам модуль с БД не работает:
+запись выполняет приложение через take_pending().
+
+Статус «печатает» живёт только в памяти: запись с TTL на каждый вызов,
+без обращений к БД.
+"""
+import threading
+import time
+from datetime import datetime
+
+
+class PresenceStore:
+    """Последние пинги пользователей с отложенной записью в БД"""
+
+    def __init__(self, flush_interval=30):
+        self.flush_interval = flush_interval
+        self._seen = {}  # user_id -> datetime последнего пинга в этом процессе
+        self._pending = {}  # user_id -> datetime, ещё не записанные в БД
+        self._last_flush = time.monotonic()
+        self._lock = threading.Lock()
+
+    def touch(self, user_id, when=None):
+        """Отметить пинг пользователя"""
+        when = when or datetime.utcnow()
+        with self._lock:
+            self._seen[user_id] = when
+            self._pending[user_id] = when
+
+    def last_seen(self, user_id):
+        """Время последнего пинга, известное этому процессу, или None"""
+        with self._lock:
+            return self._seen.get(user_id)
+
+    def flush_due(self):
+        """Пора ли записывать накопленные пинги"""
+        return bool(self._pending) and time.monotonic() - self._last_flush >= self.flush_interval
+
+    def take_pending(self):
+        """Забрать накопленные пинги для записи: {user_id: datetime}"""
+        with self._lock:
+            pending, self._pending = self._pending, {}
+            self._last_flush = time.monotonic()
+            return pending
+
+    def restore_pending(self, pending):
+        """Вернуть пинги после неудачной записи, не затирая более свежие"""
+        with self._lock:
+            for user_id, when in pending.items():
+                if user_id not in self._pending or self._pending[user_id] < when:
+                    self._pending[user_id] = when
+
+
+class TypingStore:
+    """Кто печатает в каждом чате: chat_id -> {user_id: (expires_at, name)} с коротким TTL"""
+
+    def __init__(self, ttl=6):
+        self.ttl = ttl
+        self._chats = {}
+        self._lock = threading.Lock()
+
+    def start(self, chat_id, user_id, name):
+        """Пользователь печатает (продлевает статус на ttl секунд)"""
+        with self._lock:
+            self._chats.setdefault(chat_id, {})[user_id] = (time.monotonic() + self.ttl, name)
+
+    def stop(self, chat_id, user_id):
+        """Снять статус (например, после отправки сообщения); True, если он был"""
+        with self._lock:
+            typing = self._chats.get(chat_id)
+            if not typing or typing.pop(user_id, None) is None:
+                return False
+            if not typing:
+                del self._chats[chat_id]
+            return True
+
+    def typing_users(self, chat_id):
+        """Список (user_id, name) тех, кто печатает сейчас; устаревшие записи удаляются"""
+        now = time.monotonic()
+        with self._lock:
+            typing = self._chats.get(chat_id)
+            if not typing:
+                return []
+            for user_id in [u for u, (expires_at, _) in typing.items() if expires_at <= now]:
+                del typing[user_id]
+            if not typing:
+                del self._chats[chat_id]
+                return []
+            return [(user_id, name) for user_id, (_, name) in typing.items()]
@@ -0,0 +1,87 @@
+"""
+Модуль порядка элементов (подзадачи задачи, треки плейлиста)
+
+Порядок хранится дробным рангом в колонке order. Новый элемент в конце
+получает ранг последнего + STEP, перемещённый - середину между новыми
+соседями, поэтому и вставка, и перемещение меняют ровно одну строку, а соседи
+находятся по индексу (группа, order). Когда после многих перемещений в одно
+место соседние ранги сближаются до MIN_GAP, ранги группы переписываются заново
+(rebalance): сразу, если места не осталось, или фоновой командой заранее.
+"""
+from models import db
+
+STEP = 1.0
+MIN_GAP = 1e-9  # Ближе соседей не делим: дальше не хватает точности float
+REBALANCE_GAP = 1e-6  # Фоновая перебалансировка групп с такими промежутками
+
+
+def rank_between(before, after):
+    """Ранг между соседями (None - край группы); None, если места не осталось"""
+    if before is None and after is None:
+        return STEP
+    if after is None:
+        return before + STEP
+    if before is None:
+        return after - STEP
+    if after - before < MIN_GAP:
+        return None
+    return (before + after) / 2
+
+
+def next_rank(model, parent_column, parent_id):
+    """Ранг нового элемента в конце группы: последний ранг по индексу, без пересчёта"""
+    last = db.session.query(model.order).filter(parent_column == parent_id).order_by(
+        model.order.desc()
+    ).limit(1).scalar()
+    return rank_between(last, None)
+
+
+def move(item, parent_column, after_id):
+    """
+    Поставить item сразу после элемента after_id той же группы (None - в начало).
+    Меняет только item; LookupError, если after_id не из этой группы.
+    """
+    model = type(item)
+    parent_id = getattr(item, parent_column.key)
+    siblings = db.session.query(model.order).filter(parent_column == parent_id, model.id != item.id)
+
+    if after_id is None:
+        before = None
+        after = siblings.order_by(model.order).limit(1).scalar()
+    else:
+        before = siblings.filter(model.id == after_id).scalar()
+        if before is None:
+            raise LookupError(after_id)
+        # >=: соседи с тем же рангом (старые данные) - повод перебалансировать
+        after = siblings.filter(model.id != after_id, model.order >= before).order_by(model.order).limit(1).scalar()
+
+    rank = rank_between(before, after)
+    if rank is None:
+        rebalance(model, parent_column, parent_id)
+        return move(item, parent_column, after_id)
+    item.order = rank
+    return rank
+
+
+def rebalance(model, parent_column, parent_id):
+    """Переписать ранги группы через STEP в текущем порядке (один UPDATE)"""
+    table = model.__tablename__
+    db.session.execute(db.text(f'''
+        UPDATE {table} SET "order" = ranked.position * :step
+        FROM (
+            SELECT id, ROW_NUMBER() OVER (ORDER BY "order", id) AS position
+            FROM {table} WHERE {parent_column.key} = :parent_id
+        ) AS ranked
+        WHERE {table}.id = ranked.id
+    '''), {'step': STEP, 'parent_id': parent_id})
+
+
+def crowded_groups(model, parent_column):
+    """Группы, где соседние ранги сблизились до REBALANCE_GAP или совпали"""
+    table, parent = model.__tablename__, parent_column.key
+    return [row[0] for row in db.session.execute(db.text(f'''
+        SELECT DISTINCT {parent} FROM (
+            SELECT {parent}, "order" - LAG("order") OVER (PARTITION BY {parent} ORDER BY "order", id) AS gap
+            FROM {table}
+        ) WHERE gap < :gap
+    '''), {'gap': REBALANCE_GAP})]
@@ -0,0 +1,204 @@
+"""
+Модуль полнотекстового поиска (SQLite FTS5)
+
+messages_fts - внешний FTS5-индекс по messages.content (content='messages'):
+текст хранится только в messages, индекс поддерживается триггерами на
+INSERT/UPDATE/DELETE, поэтому send/edit/delete ничего дополнительно не делают.
+
+users_fts - триграммный индекс по users.username и users.name для поиска
+подстроки; префиксы ищутся по индексам users(... COLLATE NOCASE).
+"""
+import html
+import re
+from datetime import datetime
+
+from sqlalchemy import text
+
+MESSAGE_SEARCH_DDL = [
+    """
+    CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5(
+        content,
+        content='messages',
+        content_rowid='id',
+        tokenize='unicode61 remove_diacritics 2'
+    )
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS messages_fts_ai AFTER INSERT ON messages BEGIN
+        INSERT INTO messages_fts(rowid, content) VALUES (new.id, new.content);
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS messages_fts_ad AFTER DELETE ON messages BEGIN
+        INSERT INTO messages_fts(messages_fts, rowid, content) VALUES ('delete', old.id, old.content);
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS messages_fts_au AFTER UPDATE OF content ON messages BEGIN
+        INSERT INTO messages_fts(messages_fts, rowid, content) VALUES ('delete', old.id, old.content);
+        INSERT INTO messages_fts(rowid, content) VALUES (new.id, new.content);
+    END
+    """,
+]
+
+USER_SEARCH_DDL = [
+    """
+    CREATE VIRTUAL TABLE IF NOT EXISTS users_fts USING fts5(
+        username,
+        name,
+        content='users',
+        content_rowid='id',
+        tokenize='trigram'
+    )
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS users_fts_ai AFTER INSERT ON users BEGIN
+        INSERT INTO users_fts(rowid, username, name) VALUES (new.id, new.username, new.name);
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS users_fts_ad AFTER DELETE ON users BEGIN
+        INSERT INTO users_fts(users_fts, rowid, username, name) VALUES ('delete', old.id, old.username, old.name);
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS users_fts_au AFTER UPDATE OF username, name ON users BEGIN
+        INSERT INTO users_fts(users_fts, rowid, username, name) VALUES ('delete', old.id, old.username, old.name);
+        INSERT INTO users_fts(rowid, username, name) VALUES (new.id, new.username, new.name);
+    END
+    """,
+]
+
+# Индексы: (имя таблицы, DDL, заполнение по уже существующим строкам)
+SEARCH_INDEXES = [
+    ('messages_fts', MESSAGE_SEARCH_DDL, "INSERT INTO messages_fts(messages_fts) VALUES ('rebuild')"),
+    ('users_fts', USER_SEARCH_DDL, "INSERT INTO users_fts(users_fts) VALUES ('rebuild')"),
+]
+
+# Маркеры подсветки из частной области Unicode: в тексте сообщений их нет,
+# поэтому сниппет можно экранировать целиком и только потом вставить <mark>
+_MARK_OPEN, _MARK_CLOSE = '\ue000', '\ue001'
+
+MAX_QUERY_TERMS = 8
+
+
+# Пользователи, заблокированные в любую сторону, в поиске не показываются
+_NOT_BLOCKED = """
+    NOT EXISTS (SELECT 1 FROM blocked_users b WHERE b.user_id = :user_id AND b.blocked_user_id = u.id)
+    AND NOT EXISTS (SELECT 1 FROM blocked_users b WHERE b.user_id = u.id AND b.blocked_user_id = :user_id)
+"""
+
+
+def ensure_search_indexes(conn):
+    """Создать FTS-индексы и триггеры; при первом создании проиндексировать имеющиеся строки"""
+    for table, ddl, rebuild in SEARCH_INDEXES:
+        exists = conn.exec_driver_sql(
+            f"SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = '{table}'"
+        ).first()
+        for statement in ddl:
+            conn.exec_driver_sql(statement)
+        if not exists:
+            conn.exec_driver_sql(rebuild)
+
+
+def build_match_query(query):
+    """Пользовательский ввод -> выражение MATCH: все слова, каждое как префикс"""
+    terms = re.findall(r'\w+', query)[:MAX_QUERY_TERMS]
+    return ' '.join('"{}"*'.format(term.replace('"', '""')) for term in terms)
+
+
+def highlight_snippet(snippet):
+    """Экранировать сниппет и заменить маркеры на <mark>"""
+    return html.escape(snippet).replace(_MARK_OPEN, '<mark>').replace(_MARK_CLOSE, '</mark>')
+
+
+def search_messages(session, user_id, query, limit=20, chat_id=None, after_rank=None, after_id=None):
+    """
+    Поиск по сообщениям чатов, в которых состоит пользователь.
+    Сортировка по bm25 (rank), при равенстве - новые выше; keyset по (rank, id).
+    Возвращает (строки, has_more).
+    """
+    match = build_match_query(query)
+    if not match:
+        return [], False
+
+    sql = f"""
+        SELECT m.id, m.chat_id, m.sender_id, m.created_at,
+               u.name AS sender_name, u.username AS sender_username,
+               snippet(messages_fts, 0, '{_MARK_OPEN}', '{_MARK_CLOSE}', '…', 12) AS snippet,
+               messages_fts.rank AS rank
+        FROM messages_fts
+        JOIN messages m ON m.id = messages_fts.rowid
+        JOIN chat_members_v2 cm ON cm.chat_id = m.chat_id AND cm.user_id = :user_id
+        JOIN users u ON u.id = m.sender_id
+        WHERE messages_fts MATCH :match
+          {'AND m.chat_id = :chat_id' if chat_id else ''}
+          {'AND (messages_fts.rank > :after_rank OR (messages_fts.rank = :after_rank AND m.id < :after_id))'
+           if after_rank is not None and after_id is not None else ''}
+        ORDER BY messages_fts.rank, m.id DESC
+        LIMIT :limit
+    """
+    rows = session.execute(text(sql), {
+        'user_id': user_id,
+        'match': match,
+        'chat_id': chat_id,
+        'after_rank': after_rank,
+        'after_id': after_id,
+        'limit': limit + 1
+    }).mappings().all()
+
+    results = [{
+        'id': row['id'],
+        'chat_id': row['chat_id'],
+        'sender_id': row['sender_id'],
+        'sender_name': row['sender_name'] or row['sender_username'],
+        'created_at': datetime.fromisoformat(str(row['created_at'])).isoformat(),
+        'snippet': highlight_snippet(row['snippet']),
+        'rank': row['rank']
+    } for row in rows[:limit]]
+    return results, len(rows) > limit
+
+
+def search_users(session, user_id, query, limit=10):
+    """
+    Поиск пользователей по username и имени: точные совпадения, затем префиксы,
+    затем подстроки. Каждый этап - отдельный запрос с LIMIT по индексу, поэтому
+    время не зависит от числа пользователей. Подстроки ищутся с 3 символов
+    (минимум для триграмм), на 2 символах работает только префиксный поиск.
+    """
+    like_prefix = query.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%'
+    params = {'user_id': user_id, 'prefix': like_prefix, 'limit': limit}
+
+    rows = []
+    for column in ('username', 'name'):
+        rows += session.execute(text(f"""
+            SELECT u.id, u.username, u.name, u.avatar_url FROM users u
+            WHERE u.{column} LIKE :prefix ESCAPE '\\' AND u.id != :user_id AND {_NOT_BLOCKED}
+            ORDER BY u.{column} COLLATE NOCASE
+            LIMIT :limit
+        """), params).mappings().all()
+
+    if len(query) >= 3:
+        rows += session.execute(text(f"""
+            SELECT u.id, u.username, u.name, u.avatar_url FROM users_fts
+            JOIN users u ON u.id = users_fts.rowid
+            WHERE users_fts MATCH :match AND u.id != :user_id AND {_NOT_BLOCKED}
+            LIMIT :limit
+        """), dict(params, match='"{}"'.format(query.replace('"', '""')), limit=limit * 2)).mappings().all()
+
+    needle = query.casefold()
+
+    def match_rank(row):
+        values = [(row['username'] or '').casefold(), (row['name'] or '').casefold()]
+        if needle in values:
+            return 0
+        if any(value.startswith(needle) for value in values):
+            return 1
+        return 2
+
+    users, seen = [], set()
+    for row in sorted(rows, key=match_rank):
+        if row['id'] not in seen:
+            seen.add(row['id'])
+            users.append(dict(row))
+    return users[:limit]